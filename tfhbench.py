@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Tux-FreeHost Node benchmark: run tfhnode.py against synthetic servers.
+
+For each size, a database with that many vhosts is generated (SQLite by
+default, cached in --fixtures) and the whole tfhnode.py pipeline is run
+in a fresh process against a temporary output tree, without SSL
+certificate generation nor service reloads. Two runs are measured:
+  full         first run, every vhost is generated
+  incremental  --incremental-ratio of the vhosts changed since
+
+Results can be saved with --save and compared with a previous run with
+--compare; a metric worse than the baseline by more than --threshold
+is reported as a regression and makes the command fail.
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import datetime
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.abspath(os.path.dirname(__file__))
+hostname = 'bench.tfh.local'
+
+# Higher is worse for all of them
+compared_metrics = ('wall_time', 'max_rss', 'queries')
+
+def make_fixture(url, size, seed):
+    from sqlalchemy import create_engine
+    from tfhnode.models import Base, Server, User, Group, VHost, Domain, \
+        VHostRewrite, VHostACL, VHostErrorPage
+
+    rand = random.Random(seed)
+    dbe = create_engine(url)
+    Base.metadata.drop_all(dbe)
+    Base.metadata.create_all(dbe)
+
+    now = datetime.datetime.now() - datetime.timedelta(days=1)
+    users, vhosts, domains = [], [], []
+    rewrites, acls, errorpages = [], [], []
+    # About 3 vhosts per user, mostly PHP, a few Python apps
+    for i in range(size):
+        userid = i // 3 + 1
+        if i % 3 == 0:
+            users.append({'id': userid, 'username': 'user%d'%(userid),
+                'groupid': 1, 'signup_date': now})
+        apptype = rand.choice((0x00, 0x10, 0x10, 0x10, 0x20))
+        vhosts.append({'id': i + 1, 'name': 'site%d'%(i), 'userid': userid,
+            'serverid': 1, 'update': now, 'autoindex': rand.random() < 0.2,
+            'apptype': apptype, 'catchall': rand.choice((None, '/index.php')),
+            'applocation': 'app%d'%(i) if apptype == 0x20 else None,
+            'traffic': rand.choice((0, 0, 0, 0, 0.5, 5, 80)),
+            'static_profile': rand.choice((0, 0, 1, 2))})
+        for d in range(rand.choice((1, 1, 2, 3, 5))):
+            domains.append({'userid': userid, 'vhostid': i + 1,
+                'domain': '%s.site%d.user%d.example.com'%(
+                    ('www', 'blog', 'shop', 'static', 'mail')[d], i, userid),
+                'hostedns': False, 'public': False, 'verified': True})
+        # Most sites have a few rules, migrated ones have hundreds
+        n = rand.choice((0, 0, 1, 2, 5)) if rand.random() > 0.01 else 200
+        for r in range(n):
+            rewrites.append({'vhostid': i + 1,
+                'regexp': '^/old/page%d.html$'%(r), 'dest': '/page%d'%(r),
+                'redirect_temp': False, 'redirect_perm': True, 'last': False})
+        if rand.random() < 0.1:
+            acls.append({'vhostid': i + 1, 'title': 'Private',
+                'regexp': '^/private/', 'passwd': '.htpasswd'})
+        for code in rand.choice(((), (), (404,), (404, 500))):
+            errorpages.append({'vhostid': i + 1, 'code': code,
+                'path': '/%d.html'%(code)})
+
+    with dbe.begin() as conn:
+        conn.execute(Group.__table__.insert(), [{'id': 1, 'name': 'hosted'}])
+        conn.execute(Server.__table__.insert(), [{'id': 1, 'fqdn': hostname,
+            'ipv4': '192.0.2.1', 'ipv6': '2001:db8::1'}])
+        for model, rows in ((User, users), (VHost, vhosts), (Domain, domains),
+                (VHostRewrite, rewrites), (VHostACL, acls),
+                (VHostErrorPage, errorpages)):
+            if rows:
+                conn.execute(model.__table__.insert(), rows)
+    dbe.dispose()
+
+def schema_version():
+    # Cached fixtures are rebuilt when the schema changes
+    from tfhnode.models import Base
+    columns = ' '.join('%s.%s'%(t.name, c.name)
+        for t in Base.metadata.sorted_tables for c in t.columns)
+    return hashlib.sha1(columns.encode('utf-8')).hexdigest()[:8]
+
+def touch_fixture(url, ratio, seed):
+    # Change a part of the vhosts for the incremental run
+    from sqlalchemy import create_engine, select, func
+    from tfhnode.models import VHost
+
+    dbe = create_engine(url)
+    with dbe.begin() as conn:
+        count = conn.execute(select([func.count(VHost.id)])).scalar()
+        ids = random.Random(seed).sample(range(1, count + 1),
+            max(1, int(count * ratio)))
+        conn.execute(VHost.__table__.update()
+            .where(VHost.id.in_(ids))
+            .values(update=datetime.datetime.now(), catchall='/changed.php'))
+    dbe.dispose()
+
+def run_tfhnode(url, output, args):
+    # Runs in a child process: import tfhnode.py and time main().
+    spec = importlib.util.spec_from_file_location('tfhnode_main',
+        os.path.join(here, 'tfhnode.py'))
+    tfhnode_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tfhnode_main)
+
+    os.chdir(output)
+    start = time.time()
+    summary = tfhnode_main.main([
+        '--db', url, '--hostname', hostname,
+        '--output-nginx', output+'/nginx/',
+        '--output-emperor', output+'/emperor/',
+        '--output-php', output+'/phpfpm/',
+        '--state-dir', output+'/state/',
+        '--template-cache', output+'/cache/',
+        '--ssl-workers', '0', '--no-reload-services', '--no-make-http-dirs',
+    ] + args)
+    summary['wall_time'] = time.time() - start
+    # kB on Linux
+    summary['max_rss'] = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    json.dump(summary, sys.stdout)
+
+def measure(url, output, args):
+    r = subprocess.run([sys.executable, os.path.abspath(__file__),
+        '--child', url, output, '--'] + args,
+        stdout=subprocess.PIPE, check=True, cwd=here)
+    return json.loads(r.stdout.decode('utf-8'))
+
+def bench_size(size, options):
+    if options.db:
+        url = options.db
+        make_fixture(url, size, options.seed)
+    else:
+        if not os.path.isdir(options.fixtures):
+            os.makedirs(options.fixtures)
+        path = os.path.join(options.fixtures, 'vhosts-%d-%d-%s.sqlite'%(
+            size, options.seed, schema_version()))
+        if not os.path.isfile(path):
+            logging.info('%d: generating fixture %s', size, path)
+            make_fixture('sqlite:///'+path, size, options.seed)
+        # Runs change the database, always start from a clean copy
+        url = 'sqlite:///' + os.path.join(options.workdir, 'bench.sqlite')
+        shutil.copyfile(path, url[len('sqlite:///'):])
+
+    output = os.path.join(options.workdir, 'output-%d'%(size))
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(output)
+
+    results = {}
+    logging.info('%d: full run', size)
+    args = options.args.split()
+    results['full'] = measure(url, output, ['--gen-all'] + args)
+    touch_fixture(url, options.incremental_ratio, options.seed)
+    logging.info('%d: incremental run', size)
+    results['incremental'] = measure(url, output, args)
+    return results
+
+def print_results(results):
+    print('%8s %-12s %9s %9s %8s %8s  %s'%('vhosts', 'run', 'wall (s)',
+        'rss (MB)', 'queries', 'written', 'render time (s)'))
+    for size in sorted(results, key=int):
+        for run, r in sorted(results[size].items()):
+            written = sum(s['written'] for s in r['services'].values())
+            renders = ' '.join('%s=%.3f'%(name.replace('Service', ''),
+                s['render_time']) for name, s in sorted(r['services'].items()))
+            print('%8s %-12s %9.3f %9.1f %8d %8d  %s'%(size, run,
+                r['wall_time'], r['max_rss'] / 1024, r['queries'], written,
+                renders))
+
+def compare_results(results, baseline, threshold):
+    regressions = []
+    for size in results:
+        for run in results[size]:
+            base = baseline.get(size, {}).get(run)
+            if not base:
+                continue
+            for metric in compared_metrics:
+                old, new = base[metric], results[size][run][metric]
+                if old and (new - old) / old > threshold:
+                    regressions.append('%s vhosts, %s run: %s %.3f -> %.3f (%+.0f%%)'%(
+                        size, run, metric, old, new, (new - old) / old * 100))
+    return regressions
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        # --child url output -- tfhnode.py arguments
+        run_tfhnode(sys.argv[2], sys.argv[3], sys.argv[5:])
+        return
+
+    parser = ArgumentParser(description=__doc__,
+        formatter_class=RawDescriptionHelpFormatter)
+    parser.add_argument('sizes', nargs='*', type=int,
+        default=[100, 1000, 10000, 50000], help='Number of vhosts')
+    parser.add_argument('--db', help='Database URL to use instead of SQLite '
+        '(it is dropped and recreated!)')
+    parser.add_argument('--fixtures', default='./bench/fixtures/',
+        help='Directory for generated SQLite databases')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--incremental-ratio', type=float, default=0.01,
+        dest='incremental_ratio')
+    parser.add_argument('--args', default='',
+        help='More tfhnode.py arguments, e.g. "--nginx-shards 64"')
+    parser.add_argument('--save', help='Save results to this JSON file')
+    parser.add_argument('--compare', help='Compare with this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Allowed relative regression (default: 0.2)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.WARNING)
+    options.fixtures = os.path.abspath(options.fixtures)
+    options.workdir = tempfile.mkdtemp(prefix='tfhbench-')
+    try:
+        results = {}
+        for size in options.sizes:
+            results[str(size)] = bench_size(size, options)
+    finally:
+        shutil.rmtree(options.workdir)
+
+    print_results(results)
+
+    if options.save:
+        with open(options.save, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as fh:
+            regressions = compare_results(results, json.load(fh),
+                options.threshold)
+        for r in regressions:
+            print('REGRESSION: '+r)
+        if regressions:
+            exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,39 +7,168 @@ It tries to read a ./tfhnode.ini:
 db = postgresql+psycopg2://tfhdev@localhost/tfhdev
 output-php = ./output/phpfpm/%s.conf
 output-nginx = ./output/nginx.conf
+
+By default only vhosts changed since the last successful run are
+regenerated, and files of deleted vhosts are removed. Use --gen-all to
+rebuild everything. Vhosts of users whose ~/ssl certificates (or
+~/public_http and ~/http_* directories) changed are regenerated too,
+every vhost when wildcard certificates changed, and every vhost after
+tfhnode or its templates changed (an upgrade). A run first compares a
+fingerprint of the server's vhosts and domains (row counts and last
+update times) and of these files with the one of the last run, and
+exits right away if nothing changed. Files are only rewritten, and
+services only reloaded, when their content actually changed; nginx is
+also reloaded when a certificate or key changed (a renewal in place).
+
+Missing SSL certificates are generated in the background (at most
+--ssl-workers processes, --ssl-key-type rsa or ecdsa); runs do not wait
+for them, the vhost is served over HTTP until a later run finds its
+certificate. --ssl-workers 0 disables generation.
+
+Runs do not overlap: a run exits right away while another one (or a
+daemon) holds the lock on tfhnode.lock in --state-dir (--output-root
+with --controller).
+
+With --daemon, tfhnode keeps running and regenerates vhosts as soon as
+they change, and zones as soon as domains or their entries change: on
+PostgreSQL it listens for notifications sent by the triggers from
+`tfhsetup.py --make-dbtriggers`, with other databases it polls every
+--daemon-poll seconds. Certificates and http directories
+are checked every --daemon-files seconds.
+
+With --nginx-shards N, nginx vhosts are written to N files (vhosts of a
+user always share a file) instead of one file per vhost.
+
+Server-wide nginx settings sized for the server's vhosts are written to
+--output-nginx-global: main.conf (worker_rlimit_nofile), events.conf
+(worker_connections) and http.conf (server_names hash sizes from the
+number and length of domains, open_file_cache, keepalive), to include
+in the main context, events block and http block of nginx.conf. Stock
+nginx.conf files set worker_connections and keepalive_timeout too:
+remove them from nginx.conf, or nginx refuses the duplicate directive.
+worker_processes is left to nginx.conf.
+
+With --microcache, vhosts with a VHost.microcache delay have the
+anonymous GET and HEAD responses of their PHP or uWSGI app cached by
+nginx, in zones sized for the number of such vhosts in --microcache-dir.
+The microcache stays disabled without --output-nginx-global or when
+--microcache-dir does not exist (on a node generated by the controller,
+it is assumed to exist).
+Requests with a session cookie or credentials bypass the cache;
+requests from the server itself with a "Cache-Purge: 1" header
+refresh it.
+
+With --controller, one process generates the configuration of every
+server (or of the comma-separated --servers fqdns) in
+--output-root/<fqdn>/{nginx,emperor,phpfpm,state}/, ready to be copied
+to the nodes. The vhosts of all servers are loaded with the same
+queries. Nothing is changed outside of the output trees: services are
+not reloaded, http directories and SSL certificates are not created.
+The certificates and http directories of a node are read from
+--output-root/<fqdn>/node-files.json, written on the node by
+`tfhnode.py --export-files FILE`; without it, its vhosts are generated
+without SSL and with ~/http_<vhost> as document root.
+
+Busy php-fpm and uWSGI pools share a budget of worker processes: at
+most --pool-workers-per-cpu per CPU and one per --pool-worker-memory MB
+(Server.cpus and Server.memory, or --pool-cpus and --pool-memory, or
+the local machine). Pools above --pool-idle-traffic requests/s
+(VHost.traffic) get workers in proportion to their traffic, in dynamic
+mode or static mode above --pool-static-traffic; other pools stay
+ondemand with their default number of workers, outside the budget.
+
+With --output-bind, zone files of every hosted domain (whichever server
+its vhost is on, each node being one of the nameservers) are generated
+there with a named.conf include listing them. Zones are only rewritten (and
+their serial bumped) when their entries changed, and reloaded one by
+one with rndc; BIND is only reconfigured when zones are added or
+removed. NS records and the SOA use --dns-nameservers (default: this
+server), the SOA contact is --dns-hostmaster (default:
+hostmaster.<zone>).
+
+With --nss-cache-dir, users and groups are also exported there as
+libnss-cache files (passwd.cache, group.cache, shadow.cache and their
+indexes), for the `cache` NSS module. Files are only replaced when
+their content changed.
+
+Vhosts are loaded, rendered and written by batches of about
+--batch-size, so memory use does not grow with the number of vhosts.
+They are rendered by --render-workers processes (0: one per CPU) and
+written by --io-workers threads.
+
+Each run can export its timings (per phase, per service and the
+--slow-vhosts slowest vhosts) to a Prometheus node-exporter textfile
+(--metrics-textfile) and to a JSON report (--report-json). A run longer
+than --run-budget seconds is logged and flagged in the metrics. Runs
+that find nothing to do export them too, with no vhost generated.
 """
 
 from argparse import ArgumentParser, ArgumentError, RawDescriptionHelpFormatter
 from configparser import ConfigParser
 import logging
-import datetime
 import os
+import fcntl
 import socket
-from tfhnode.models import *
-from tfhnode.services import *
-from sqlalchemy import *
-from sqlalchemy.orm import sessionmaker
-import psycopg2
+import time
+from tfhnode import fingerprint, certs
 
 options = {
     'db' : 'postgresql+psycopg2://tfhdev@localhost/tfhdev',
     'output-php' : './output/phpfpm/',
     'output-emperor' : './output/emperor/',
     'output-nginx' : './output/nginx/',
+    'output-nginx-global' : './output/nginx-global/',
+    'microcache' : False,
+    'microcache-dir' : '/var/cache/nginx/',
+    'state-dir' : './output/state/',
+    'template-cache' : './cache/templates/',
     'hostname' : None,
     'ssl-port' : '444',
-    'gen-all' : True,
+    'ssl-workers' : '2',
+    'ssl-key-type' : 'rsa',
+    'gen-all' : False,
     'make-http-dirs' : True,
     'reload-services' : True,
     'require-verified-domains' : True,
+    'query-report' : False,
+    'daemon' : False,
+    'daemon-poll' : '5',
+    'daemon-debounce' : '0.2',
+    'daemon-files' : '60',
+    'metrics-textfile' : None,
+    'report-json' : None,
+    'slow-vhosts' : '10',
+    'run-budget' : None,
+    'render-workers' : '0',
+    'io-workers' : '8',
+    'nginx-shards' : '0',
+    'controller' : False,
+    'servers' : None,
+    'output-root' : './output/servers/',
+    'export-files' : None,
+    'pool-cpus' : '0',
+    'pool-memory' : '0',
+    'pool-workers-per-cpu' : '4',
+    'pool-worker-memory' : '256',
+    'pool-idle-traffic' : '0.1',
+    'pool-static-traffic' : '50',
+    'nss-cache-dir' : None,
+    'output-bind' : None,
+    'dns-nameservers' : None,
+    'dns-hostmaster' : None,
+    'dns-ttl' : '3600',
+    'batch-size' : '500',
 }
 
-def main():
+def main(argv=None):
     config = ConfigParser()
     config.read('./tfhnode.ini')
     if 'node' in config:
         for d in config.items('node'):
-            options[d[0]] = d[1]
+            if isinstance(options.get(d[0]), bool):
+                options[d[0]] = config.getboolean('node', d[0])
+            else:
+                options[d[0]] = d[1]
 
     parser = ArgumentParser(description=__doc__)
     parser.set_defaults(**options)
@@ -57,7 +186,7 @@ def main():
         except ArgumentError:
             pass
 
-    cli_options = vars(parser.parse_args())
+    cli_options = vars(parser.parse_args(argv))
     for o in cli_options:
         options[o] = cli_options[o]
 
@@ -69,69 +198,64 @@ def main():
         elif verbose >= 2:
             log_level = logging.DEBUG
     logging.basicConfig(level=log_level)
-    
+
+    if options['controller'] and options['daemon']:
+        parser.error('--controller cannot be used with --daemon')
+
+    if options['export-files']:
+        fingerprint.save_state(*os.path.split(options['export-files']),
+            certs.get_local_state())
+        return None
+
     directories = (
         options['output-nginx'],
+        options['output-nginx-global'],
         options['output-emperor'],
         options['output-php'],
+        options['state-dir'],
+        options['output-bind'],
     )
     for directory in directories:
-        if not os.path.exists(directory):
+        if options['controller']:
+            break
+        if directory and not os.path.exists(directory):
             os.makedirs(directory)
 
-    dbe = create_engine(options['db'])
-    dbs = sessionmaker(bind=dbe)()
-
-    server = get_server(dbs, options)
-
-    nginx_service = NginxService(options['output-nginx'], '/run/nginx.pid',
-        server=server, options=options)
-    uwsgi_service = UwsgiService(options['output-emperor'])
-    phpfpm_service = PhpfpmService(options['output-php'], '/run/php5-fpm.pid')
-
-    appservices = {
-        0x10 : phpfpm_service,
-        0x20 : uwsgi_service,
-    }
-
-    vhosts = dbs.query(VHost).filter_by(server=server).all()
-    nginx_service.clear()
-    uwsgi_service.clear()
-    phpfpm_service.clear()
-    for vhost in vhosts:
-        nginx_service.generate_vhost(vhost)
-        gen_vhost_app(vhost, appservices)
-
-    if options['reload-services']:
-        reload_services((nginx_service, uwsgi_service, phpfpm_service))
-
-    server.lastupdate = datetime.datetime.now()
-    dbs.commit()
-    
-def get_server(dbs, options):
-    hostname = options['hostname'] or socket.gethostname()
-    logging.info('server: hostname is %s'%(hostname))
-
-    server = dbs.query(Server).filter_by(fqdn=hostname).first()
-    if not server:
-        logging.critical('server: Cannot find server id in database.')
-        exit(1)
-
-    logging.info('server: #%d Last run: %s'%(server.id, server.lastupdate))
-    return server
-
-def gen_vhost_app(vhost, services):
-    for apptype, service in services.items():
-        if vhost.apptype & apptype:
-            service.generate_vhost(vhost)
-        else:
-            #service.remove_vhost(vhost)
-            pass
+    lock_dir = options['output-root'] if options['controller'] \
+        else options['state-dir']
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    lock = open(os.path.join(lock_dir, 'tfhnode.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logging.warning('server: another run is in progress, exiting')
+        lock.close()
+        return None
 
-def reload_services(services):
-    for service in services:
-        service.reload()
+    # Most runs have nothing to do: check it before loading SQLAlchemy
+    # and the templates.
+    run_fingerprint = None
+    if not options['controller'] and not options['daemon']:
+        start = time.time()
+        hostname = options['hostname'] or socket.gethostname()
+        run_fingerprint = fingerprint.get_fingerprint(options, hostname)
+        if not options['gen-all'] and fingerprint.is_unchanged(
+            options['state-dir'], run_fingerprint):
+            logging.info('server: nothing changed since the last run')
+            fingerprint.export_skipped_run(options, hostname,
+                time.time() - start)
+            lock.close()
+            return None
+
+    from tfhnode.generator import run
+    try:
+        summary = run(options)
+        if run_fingerprint:
+            fingerprint.save(options['state-dir'], run_fingerprint)
+    finally:
+        lock.close()
+    return summary
 
 if __name__ == '__main__':
     main()
-
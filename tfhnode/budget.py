@@ -0,0 +1,141 @@
+from collections import namedtuple
+import os
+import json
+import logging
+
+# Worker processes of a php-fpm or uWSGI pool.
+# mode is 'ondemand' (idle pools), 'dynamic' or 'static' (busy pools).
+Pool = namedtuple('Pool', 'mode children start min_spare max_spare memory')
+
+# Pools of idle vhosts, as they were before budgets
+default_children = {
+    'php' : 2,
+    'uwsgi' : 1,
+}
+
+def get_pool_keys(username, name, apptype):
+    keys = []
+    if apptype & 0x10:
+        # One php-fpm pool per user
+        keys.append('php:%s'%(username))
+    if apptype & 0x20:
+        keys.append('uwsgi:%s_%s'%(username, name))
+    return keys
+
+def get_local_cpus():
+    return os.cpu_count() or 1
+
+def get_local_memory():
+    # MB
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+
+def split(total, weights):
+    # Split total between the keys of weights, in proportion to their
+    # weight (largest remainder method).
+    weight = sum(weights.values())
+    if not total or not weight:
+        return dict((k, 0) for k in weights)
+    shares = dict((k, total * w / weight) for k, w in weights.items())
+    parts = dict((k, int(s)) for k, s in shares.items())
+    left = total - sum(parts.values())
+    for k in sorted(shares, key=lambda k: (parts[k] - shares[k], k))[:left]:
+        parts[k] += 1
+    return parts
+
+class WorkerBudget(object):
+    """ Split the worker processes of a server between its php-fpm and
+    uWSGI pools.
+
+    The server has min(cpus * pool-workers-per-cpu, memory /
+    pool-worker-memory) workers, shared by busy pools (VHost.traffic,
+    in requests per second) in proportion to their traffic. Idle pools
+    stay ondemand with their default number of workers: their processes
+    are not resident, they are not counted. When the budget is too
+    small for the busy pools, each gets one worker and only the busiest
+    ones, at most one per worker, keep it running. Allocations are saved
+    in the state directory, vhosts whose pool changed are regenerated.
+    """
+    def __init__(self, server, options):
+        self.worker_memory = int(options['pool-worker-memory'])
+        self.idle_traffic = float(options['pool-idle-traffic'])
+        self.static_traffic = float(options['pool-static-traffic'])
+        cpus = server.cpus or int(options['pool-cpus']) or get_local_cpus()
+        memory = server.memory or int(options['pool-memory']) \
+            or get_local_memory()
+        self.workers = min(cpus * int(options['pool-workers-per-cpu']),
+            memory // self.worker_memory)
+        self.state_file = os.path.join(options['state-dir'], 'pools.json')
+        self.pools = {}
+
+    def allocate(self, vhosts):
+        # vhosts: every vhost of the server (see list_vhosts)
+        traffic = {}
+        for v in vhosts:
+            for key in get_pool_keys(v.username, v.name, v.apptype):
+                traffic[key] = traffic.get(key, 0.0) + (v.traffic or 0.0)
+        if not traffic:
+            self.pools = {}
+            return
+
+        busy = dict((k, t) for k, t in traffic.items() if t > self.idle_traffic)
+        minimum = dict((k, default_children[k.split(':')[0]]) for k in busy)
+        if sum(minimum.values()) > self.workers:
+            # One worker per pool, and only the busiest pools keep
+            # their workers running: the others go back to ondemand.
+            minimum = dict((k, 1) for k in busy)
+            demoted = sorted(busy, key=lambda k: (busy[k], k))[
+                :max(0, len(busy) - self.workers)]
+            for key in demoted:
+                del busy[key], minimum[key]
+            logging.log(logging.WARNING if demoted else logging.INFO,
+                'budget: %d workers for %d busy pools, %d moved to '
+                'ondemand'%(self.workers, len(busy) + len(demoted),
+                len(demoted)))
+        extra = split(max(0, self.workers - sum(minimum.values())), busy)
+
+        self.pools = {}
+        for key, t in traffic.items():
+            if key in busy:
+                self.pools[key] = self.get_pool(minimum[key] + extra[key], t)
+            else:
+                # Ondemand, whatever its traffic
+                self.pools[key] = self.get_pool(
+                    default_children[key.split(':')[0]], 0.0)
+
+    def get_pool(self, children, traffic):
+        if traffic <= self.idle_traffic:
+            mode = 'ondemand'
+        elif traffic >= self.static_traffic or children < 2:
+            mode = 'static'
+        else:
+            mode = 'dynamic'
+        spare = max(1, children // 4)
+        return Pool(mode, children, spare, spare,
+            max(spare + 1, children // 2), self.worker_memory)
+
+    def get(self, key):
+        pool = self.pools.get(key)
+        if pool is None:
+            pool = self.get_pool(default_children[key.split(':')[0]], 0.0)
+        return pool
+
+    def get_affected_vhosts(self, vhosts):
+        # IDs of the vhosts whose pool changed since the last run
+        try:
+            with open(self.state_file) as fh:
+                old = json.load(fh)
+        except FileNotFoundError:
+            old = {}
+        affected = set()
+        for v in vhosts:
+            for key in get_pool_keys(v.username, v.name, v.apptype):
+                if key in self.pools and old.get(key) != list(self.pools[key]):
+                    affected.add(v.id)
+        return affected
+
+    def save(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(dict((k, list(p)) for k, p in self.pools.items()), fh,
+                sort_keys=True)
+        os.replace(tmp, self.state_file)
@@ -0,0 +1,399 @@
+import os
+import json
+import fcntl
+import shutil
+import logging
+import tempfile
+import subprocess
+from .provision import chown
+
+def get_user_cert_paths(username, name):
+    base = '/home/%s/ssl/%s' % (username, name)
+    return base+'.crt', base+'.csr', base+'.key'
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def get_file_mtimes(path, prefix, suffixes):
+    # filename -> mtime of the files of directory path
+    try:
+        files = os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+    mtimes = {}
+    for f in files:
+        if f.startswith(prefix) and f.endswith(suffixes):
+            mtimes[f] = get_mtime(os.path.join(path, f))
+    return mtimes
+
+def get_user_state(username):
+    # What the generated config of a user's vhosts depends on, on disk:
+    # the certificates and keys in ~/ssl and, when ~/public_http exists,
+    # the ~/http_<vhost> directories (used first).
+    home = '/home/%s' % (username)
+    certs = get_file_mtimes(os.path.join(home, 'ssl'), '', ('.crt', '.key'))
+    pubdirs = None
+    if os.path.isdir(os.path.join(home, 'public_http')):
+        pubdirs = sorted(f for f in os.listdir(home) if f.startswith('http_')
+            and os.path.isdir(os.path.join(home, f)))
+    return [certs, pubdirs]
+
+def get_local_state():
+    # CertIndex.get_state() of every user of this server, for
+    # tfhnode.py --export-files
+    users = [f for f in os.listdir('/home')
+        if os.path.isdir(os.path.join('/home', f))]
+    return CertIndex().get_state(users)
+
+def get_state_changes(old, new):
+    """ Compare two CertIndex.get_state() results.
+
+    Returns the usernames whose files changed, whether wildcard
+    certificates changed (every vhost may use them) and whether any
+    certificate or key in use changed.
+    """
+    if not old:
+        return set(new['users']), True, True
+    wildcards = old.get('wildcards') != new['wildcards']
+    users = set()
+    certs = wildcards
+    old_users = old.get('users', {})
+    for username, state in new['users'].items():
+        old_state = old_users.get(username)
+        if old_state != state:
+            users.add(username)
+            if not old_state or old_state[0] != state[0]:
+                certs = True
+    return users, wildcards, certs
+
+class CertIndex(object):
+    """ Index of user and wildcard certificates, and of the http
+    directories of vhosts.
+
+    Directories are listed once and listed again only when their mtime
+    changed, so a long running process can keep the index between runs.
+    Call refresh() at the start of each run.
+    """
+    def __init__(self, cert_dir='/etc/ssl/tfhcerts', key_dir='/etc/ssl/tfhkeys'):
+        self.cert_dir = cert_dir
+        self.key_dir = key_dir
+        self.run = 0
+        self.wildcard_mtimes = None
+        self.wildcards = {}
+        # username -> (run, mtime, filenames)
+        self.users = {}
+
+    def refresh(self):
+        self.run += 1
+        mtimes = (get_mtime(self.cert_dir), get_mtime(self.key_dir))
+        if mtimes == self.wildcard_mtimes:
+            return
+        logging.debug('ssl: indexing wildcard certificates')
+        self.wildcard_mtimes = mtimes
+        self.wildcards = {}
+        certs = self.list_dir(self.cert_dir, 'wildcard.', '.crt')
+        keys = self.list_dir(self.key_dir, 'wildcard.', '.key')
+        for suffix in certs & keys:
+            cert = os.path.join(self.cert_dir, 'wildcard.%s.crt' % (suffix))
+            key = os.path.join(self.key_dir, 'wildcard.%s.key' % (suffix))
+            if os.path.isfile(cert) and os.path.isfile(key):
+                self.wildcards[suffix] = (cert, key)
+
+    def get_state(self, usernames):
+        # mtimes of the certificates, keys and directories the vhosts of
+        # usernames are generated from (see get_state_changes).
+        return {
+            'wildcards' : [get_file_mtimes(self.cert_dir, 'wildcard.', '.crt'),
+                get_file_mtimes(self.key_dir, 'wildcard.', '.key')],
+            'users' : dict((u, get_user_state(u)) for u in sorted(usernames)),
+        }
+
+    def list_dir(self, path, prefix, suffix):
+        try:
+            files = os.listdir(path)
+        except FileNotFoundError:
+            return set()
+        return set(f[len(prefix):-len(suffix)] for f in files
+            if f.startswith(prefix) and f.endswith(suffix))
+
+    def get_user_files(self, username, ssl_dir):
+        cached = self.users.get(username)
+        if cached and cached[0] == self.run:
+            return cached[2]
+        mtime = get_mtime(ssl_dir)
+        if cached and cached[1] == mtime:
+            files = cached[2]
+        elif mtime is None:
+            files = frozenset()
+        else:
+            files = frozenset(os.listdir(ssl_dir))
+        self.users[username] = (self.run, mtime, files)
+        return files
+
+    def is_file(self, path):
+        return os.path.isfile(path)
+
+    def is_dir(self, path):
+        return os.path.isdir(path)
+
+    def get_pubdir(self, username, name):
+        # (document root of a vhost, whether it exists)
+        pubdir = '/home/%s/http_%s/' % (username, name)
+        if os.path.isdir(pubdir):
+            return pubdir, True
+        oldpubdir = '/home/%s/public_http/' % (username)
+        if os.path.isdir(oldpubdir):
+            return oldpubdir, True
+        return pubdir, False
+
+    def lookup(self, vhost):
+        # User-provided SSL cert
+        user_cert, user_csr, user_key = get_user_cert_paths(
+            vhost.user.username, vhost.name)
+        ssl_dir = os.path.dirname(user_cert)
+        files = self.get_user_files(vhost.user.username, ssl_dir)
+        if os.path.basename(user_cert) in files \
+            and os.path.basename(user_key) in files \
+            and self.is_file(user_cert) and self.is_file(user_key):
+            logging.debug('-> found user SSL cert.')
+            return (user_cert, user_key)
+
+        # System-wide wildcard
+        for domain in vhost.domains:
+            parts = domain.domain.split('.')
+            for i in range(1, len(parts)-1):
+                r = self.wildcards.get('.'.join(parts[i:]))
+                if r:
+                    logging.debug('-> found wildcard SSL cert.')
+                    return r
+
+        return None
+
+class NodeCertIndex(CertIndex):
+    """ CertIndex of another server, from the CertIndex.get_state() it
+    exported (tfhnode.py --export-files), for the controller mode.
+    Nothing is read from the local filesystem.
+    """
+    def __init__(self, state=None, **kwargs):
+        CertIndex.__init__(self, **kwargs)
+        self.state = state or {'wildcards': [{}, {}], 'users': {}}
+
+    def refresh(self):
+        self.run += 1
+        certs, keys = self.state['wildcards']
+        self.wildcards = {}
+        for f in certs:
+            suffix = f[len('wildcard.'):-len('.crt')]
+            key = 'wildcard.%s.key' % (suffix)
+            if key in keys:
+                self.wildcards[suffix] = (os.path.join(self.cert_dir, f),
+                    os.path.join(self.key_dir, key))
+
+    def get_user_state(self, username):
+        return self.state['users'].get(username) or [{}, None]
+
+    def get_user_files(self, username, ssl_dir):
+        return self.get_user_state(username)[0]
+
+    def is_file(self, path):
+        return True
+
+    def is_dir(self, path):
+        return True
+
+    def get_pubdir(self, username, name):
+        pubdirs = self.get_user_state(username)[1]
+        if pubdirs is not None and 'http_%s' % (name) not in pubdirs:
+            return '/home/%s/public_http/' % (username), True
+        return '/home/%s/http_%s/' % (username, name), True
+
+def generate_ssl_cert(username, name, domain, key_type='rsa'):
+    # Runs in a detached CertQueue job.
+    # TODO: CACert ?
+    bits = 4096
+    days = 3650
+    cert_org = 'Tux-FreeHost'
+
+    user_cert, user_csr, user_key = get_user_cert_paths(username, name)
+    ssl_dir = os.path.dirname(user_cert)
+    if not os.path.isdir(ssl_dir):
+        os.makedirs(ssl_dir)
+    if os.path.isfile(user_cert) and os.path.isfile(user_key):
+        logging.debug('-> SSL cert already exists.')
+        return (user_cert, user_key)
+
+    # Generated aside and renamed, nginx never sees a partial pair
+    tmp = tempfile.mkdtemp(prefix='.tfhnode-', dir=ssl_dir)
+    try:
+        cert, csr, key = (os.path.join(tmp, os.path.basename(f))
+            for f in (user_cert, user_csr, user_key))
+        if key_type == 'ecdsa':
+            logging.debug('-> generating ECDSA key...')
+            subprocess.check_call(['openssl', 'ecparam', '-genkey', '-noout',
+                '-name', 'prime256v1', '-out', key])
+        else:
+            logging.debug('-> generating RSA key...')
+            subprocess.check_call(['openssl', 'genrsa', '-out', key, str(bits)])
+        os.chmod(key, 0o400)
+
+        logging.debug('-> generating CSR...')
+        subprocess.check_call(['openssl', 'req', '-new', '-days', str(days),
+            '-key', key, '-out', csr, '-batch',
+            '-subj', '/C=FR/O=%s/CN=%s'%(cert_org, domain)])
+
+        logging.debug('-> generating certificate...')
+        subprocess.check_call(['openssl', 'x509', '-req', '-days', str(days),
+            '-in', csr, '-signkey', key, '-out', cert])
+
+        for f in (cert, csr, key):
+            chown(f, username)
+
+        # The certificate goes last: a certificate left without its key
+        # would match the new key for a moment.
+        if os.path.isfile(user_cert):
+            os.remove(user_cert)
+        os.replace(key, user_key)
+        os.replace(csr, user_csr)
+        os.replace(cert, user_cert)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return (user_cert, user_key)
+
+def lock_file(filename):
+    # Returns the file descriptor of filename locked, None if it is
+    # already locked
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def run_detached(fd, function, *args):
+    # Run function(*args) in a process that outlives this one, holding
+    # fd (a locked file) until it is done; an error is written in fd.
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        null = os.open(os.devnull, os.O_RDWR)
+        for std in (0, 1, 2):
+            os.dup2(null, std)
+        # The run lock, database connections...
+        os.closerange(3, fd)
+        os.closerange(fd + 1, os.sysconf('SC_OPEN_MAX'))
+        error = ''
+        try:
+            function(*args)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+        os.ftruncate(fd, 0)
+        os.write(fd, error.encode('utf-8'))
+    finally:
+        os._exit(0)
+
+class CertQueue(object):
+    """ Generate self-signed certificates in detached processes.
+
+    Runs do not wait for them. Vhosts waiting for a certificate are
+    saved in state_file and regenerated by a later run, once their
+    certificate is in ~/ssl. A job holds a lock on jobs_dir/<vhost
+    id>.lock while it runs, so that later runs do not start it again,
+    and leaves its error there if it failed. At most workers jobs run
+    at the same time. Jobs are submitted while vhosts are rendered and
+    started by start(), once the render and I/O workers are gone: no
+    other thread may hold a lock when the process forks.
+    """
+    def __init__(self, workers, key_type, state_file, jobs_dir):
+        self.workers = workers
+        self.key_type = key_type
+        self.state_file = state_file
+        self.jobs_dir = jobs_dir
+        self.submitted = set()
+        self.jobs = []
+        try:
+            with open(state_file) as fh:
+                self.pending = set(json.load(fh))
+        except FileNotFoundError:
+            self.pending = set()
+
+    def get_lock_file(self, vhostid):
+        return os.path.join(self.jobs_dir, '%d.lock'%(vhostid))
+
+    def get_running(self, vhostid):
+        # Number of jobs still running, other than the one of vhostid
+        running = 0
+        for f in os.listdir(self.jobs_dir):
+            if not f.endswith('.lock') or f == '%d.lock'%(vhostid):
+                continue
+            fd = lock_file(os.path.join(self.jobs_dir, f))
+            if fd is None:
+                running += 1
+            else:
+                os.close(fd)
+        return running
+
+    def submit(self, vhost):
+        # With no workers, certificates are never generated.
+        if not self.workers or vhost.id in self.submitted:
+            return
+        self.submitted.add(vhost.id)
+        self.pending.add(vhost.id)
+        self.jobs.append((vhost.id, vhost.user.username, vhost.name,
+            vhost.domains[0].domain))
+
+    def start(self):
+        # Start the submitted jobs, from a process without other threads
+        jobs, self.jobs = self.jobs, []
+        if jobs and not os.path.isdir(self.jobs_dir):
+            os.makedirs(self.jobs_dir, mode=0o700)
+        for vhostid, username, name, domain in jobs:
+            fd = lock_file(self.get_lock_file(vhostid))
+            if fd is None:
+                logging.debug('vhost#%d: SSL certificate generation still '
+                    'running'%(vhostid))
+                continue
+            try:
+                error = os.read(fd, 4096).decode('utf-8', 'replace')
+                if error:
+                    logging.error('vhost#%d: SSL certificate generation '
+                        'failed: %s', vhostid, error)
+                if self.get_running(vhostid) >= self.workers:
+                    logging.info('vhost#%d: SSL certificate generation '
+                        'postponed'%(vhostid))
+                    continue
+                logging.info('vhost#%d: started SSL certificate generation'%(
+                    vhostid))
+                os.ftruncate(fd, 0)
+                run_detached(fd, generate_ssl_cert, username, name, domain,
+                    self.key_type)
+            finally:
+                os.close(fd)
+
+    def save(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(sorted(self.pending), fh)
+        os.replace(tmp, self.state_file)
+        self.submitted = set()
+        # Lock files of finished jobs, runs do not overlap (see
+        # tfhnode.py) so nothing else opens them
+        if not os.path.isdir(self.jobs_dir):
+            return
+        for f in os.listdir(self.jobs_dir):
+            name = os.path.join(self.jobs_dir, f)
+            if f.endswith('.lock') and f[:-5].isdigit() \
+                and int(f[:-5]) not in self.pending:
+                fd = lock_file(name)
+                if fd is not None:
+                    os.remove(name)
+                    os.close(fd)
@@ -0,0 +1,188 @@
+"""
+Fingerprint of what a server's configuration is generated from, to
+skip runs where nothing changed without loading SQLAlchemy and the
+templates. Only the standard library (and the DBAPI module) is used.
+"""
+
+from urllib.parse import urlsplit, unquote
+import os
+import json
+import hashlib
+import logging
+from .certs import CertIndex
+from .stats import get_skipped_summary, prometheus_metrics
+
+# Tables of a vhost's generated config, other than vhosts and domains.
+# Changing their rows bumps VHost.update (see models.touch_vhosts),
+# counting them catches deletions.
+vhost_children = ('vhostrewrites', 'vhostacls', 'vhosterrorpages')
+
+# Options that do not change the generated files
+ignored_options = ('verbose', 'gen-all', 'query-report', 'metrics-textfile',
+    'report-json', 'slow-vhosts', 'run-budget', 'render-workers',
+    'io-workers', 'batch-size')
+
+# Rows exported by nsscache.get_maps(). Users have no update timestamp,
+# their fields are hashed.
+nss_queries = (
+    'SELECT id, username, groupid, shell, password FROM users ORDER BY id',
+    'SELECT id, name FROM groups ORDER BY id',
+    'SELECT userid, groupid FROM usergroups ORDER BY userid, groupid',
+)
+
+def get_nss_hash(cursor):
+    h = hashlib.sha1()
+    for query in nss_queries:
+        cursor.execute(query)
+        rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                h.update(json.dumps(list(row), default=str).encode('utf-8'))
+                h.update(b'\n')
+            rows = cursor.fetchmany(1000)
+        h.update(b'\0')
+    return h.hexdigest()
+
+def get_code_hash():
+    # Hash of the templates and of the modules rendering them: vhosts
+    # that did not change are regenerated after an upgrade of tfhnode
+    root = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha1()
+    for d in ('', 'templates'):
+        for f in sorted(os.listdir(os.path.join(root, d))):
+            path = os.path.join(root, d, f)
+            if not os.path.isfile(path) or not (d or f.endswith('.py')):
+                continue
+            h.update(os.path.join(d, f).encode('utf-8') + b'\0')
+            with open(path, 'rb') as fh:
+                h.update(fh.read())
+    return h.hexdigest()
+
+def connect(url):
+    # DBAPI connection and parameter placeholder for a SQLAlchemy URL,
+    # None for other databases.
+    u = urlsplit(url)
+    dialect = u.scheme.split('+')[0]
+    if dialect == 'sqlite' and u.path not in ('', '/'):
+        import sqlite3
+        return sqlite3.connect(unquote(u.path[1:])), '?'
+    if dialect in ('postgresql', 'postgres') and u.scheme in (
+        dialect, dialect+'+psycopg2'):
+        import psycopg2
+        kwargs = {'dbname': unquote(u.path[1:])}
+        if u.hostname:
+            kwargs['host'] = u.hostname
+        if u.port:
+            kwargs['port'] = u.port
+        if u.username:
+            kwargs['user'] = unquote(u.username)
+        if u.password:
+            kwargs['password'] = unquote(u.password)
+        return psycopg2.connect(**kwargs), '%s'
+    return None, None
+
+def get_query(placeholder, all_domains):
+    vhosts = 'FROM vhosts v WHERE v.serverid = s.id'
+    columns = ['s.lastupdate IS NULL',
+        's.id', 's.name', 's.ipv4', 's.ipv6', 's.cpus', 's.memory',
+        '(SELECT count(*) %s)'%(vhosts),
+        '(SELECT max(v.id) %s)'%(vhosts),
+        '(SELECT max(v."update") %s)'%(vhosts),
+        '(SELECT sum(v.traffic) %s)'%(vhosts)]
+    if all_domains:
+        # Zones of every hosted domain are generated
+        domains = 'FROM domains d'
+    else:
+        domains = 'FROM domains d JOIN vhosts v ON v.id = d.vhostid ' \
+            'WHERE v.serverid = s.id'
+    columns += ['(SELECT count(*) %s)'%(domains),
+        '(SELECT max(d.id) %s)'%(domains),
+        '(SELECT max(d."update") %s)'%(domains)]
+    for table in vhost_children:
+        children = 'FROM %s c JOIN vhosts v ON v.id = c.vhostid ' \
+            'WHERE v.serverid = s.id'%(table)
+        columns += ['(SELECT count(*) %s)'%(children),
+            '(SELECT max(c.id) %s)'%(children)]
+    return 'SELECT %s FROM servers s WHERE s.fqdn = %s'%(
+        ', '.join(columns), placeholder)
+
+def get_users_query(placeholder):
+    return 'SELECT DISTINCT u.username FROM users u ' \
+        'JOIN vhosts v ON v.userid = u.id ' \
+        'JOIN servers s ON s.id = v.serverid WHERE s.fqdn = %s'%(placeholder)
+
+def get_fingerprint(options, hostname):
+    """ Fingerprint of the data and options a run of this server uses,
+    in one aggregate query, and of the certificates and directories of
+    its users (see CertIndex.get_state). None if it cannot be computed,
+    or if the server has to be regenerated entirely.
+    """
+    try:
+        conn, placeholder = connect(options['db'])
+    except Exception as e:
+        logging.debug('fingerprint: cannot connect: %s'%(e))
+        return None
+    if conn is None:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(get_query(placeholder, bool(options['output-bind'])),
+            (hostname,))
+        row = cursor.fetchone()
+        cursor.execute(get_users_query(placeholder), (hostname,))
+        usernames = [r[0] for r in cursor.fetchall()]
+        nss = get_nss_hash(cursor) if options['nss-cache-dir'] else None
+    except Exception as e:
+        logging.debug('fingerprint: query failed: %s'%(e))
+        return None
+    finally:
+        conn.close()
+    if row is None or row[0]:
+        return None
+    opts = dict((k, v) for k, v in options.items() if k not in ignored_options)
+    files = CertIndex().get_state(usernames)
+    # The microcache is disabled while its directory is missing
+    microcache = bool(options['microcache']) \
+        and os.path.isdir(options['microcache-dir'] or '')
+    data = json.dumps([list(row[1:]), opts, files, microcache,
+        get_code_hash(), nss], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def load_state(state_dir, name):
+    try:
+        with open(os.path.join(state_dir, name)) as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def is_unchanged(state_dir, fingerprint):
+    # Certificates still being generated need another run
+    return fingerprint is not None \
+        and load_state(state_dir, 'fingerprint.json') == fingerprint \
+        and not load_state(state_dir, 'ssl-pending.json')
+
+def save_state(state_dir, name, value):
+    filename = os.path.join(state_dir, name)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(value, fh, sort_keys=True)
+    os.replace(tmp, filename)
+
+def export_skipped_run(options, hostname, duration):
+    # Metrics and report of a run that found nothing to do, so that
+    # tfhnode_run_timestamp_seconds shows the node is alive
+    summary = get_skipped_summary(hostname, duration)
+    outputs = []
+    if options['metrics-textfile']:
+        outputs.append((options['metrics-textfile'],
+            prometheus_metrics(summary, {'server': hostname})))
+    if options['report-json']:
+        outputs.append((options['report-json'], json.dumps(summary, indent=2)))
+    for filename, content in outputs:
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(content)
+        os.replace(tmp, filename)
+
+def save(state_dir, fingerprint):
+    save_state(state_dir, 'fingerprint.json', fingerprint)
@@ -0,0 +1,528 @@
+"""
+Generation runs of tfhnode.py, imported once a run has something to do.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import logging
+import datetime
+import os
+import socket
+import time
+import json
+from sqlalchemy import create_engine, and_, or_, func
+from sqlalchemy.orm import sessionmaker, joinedload, subqueryload
+from .models import User, Server, VHost, Domain
+from .services import NginxService, UwsgiService, PhpfpmService, \
+    BindService, write_file
+from .stats import QueryStats, RunStats, prometheus_metrics
+from .certs import CertIndex, NodeCertIndex, CertQueue, get_state_changes
+from .fingerprint import load_state, save_state, get_code_hash
+from . import render
+from .records import snapshot_vhost
+from .provision import Provisioner
+from .budget import WorkerBudget
+from .nsscache import write_nss_cache
+from .pipeline import generate_vhosts, get_workers
+from .watch import NotifyWatcher, PollWatcher
+
+def run(options):
+    if options['template-cache']:
+        render.set_cache_dir(options['template-cache'])
+
+    dbe = create_engine(options['db'])
+    query_stats = QueryStats(dbe)
+    run_stats = RunStats(int(options['slow-vhosts']), query_stats)
+    with run_stats.phase('db_connect'):
+        dbe.connect().close()
+    Session = sessionmaker(bind=dbe)
+
+    if options['controller']:
+        summary = generate_servers(Session(), options, run_stats=run_stats)
+        summary['query_time'] = query_stats.time
+        if options['query-report']:
+            print(query_stats.report())
+        return summary
+
+    cert_index = CertIndex()
+    cert_queue = CertQueue(int(options['ssl-workers']), options['ssl-key-type'],
+        os.path.join(options['state-dir'], 'ssl-pending.json'),
+        os.path.join(options['state-dir'], 'ssl-jobs'))
+
+    if options['daemon']:
+        run_daemon(dbe, Session, options, cert_index, cert_queue, query_stats)
+        return
+
+    summary = generate(Session(), options, cert_index, cert_queue,
+        run_stats=run_stats)
+    summary['query_time'] = query_stats.time
+
+    if options['query-report']:
+        print(query_stats.report())
+    return summary
+
+def generate(dbs, options, cert_index, cert_queue, vhostids=None,
+             run_stats=None):
+    # Regenerate the vhosts in vhostids, or all vhosts changed since the
+    # last run if None.
+    if run_stats is None:
+        run_stats = RunStats(int(options['slow-vhosts']))
+
+    # Changes made while we run will be picked up by the next run
+    run_start = datetime.datetime.now()
+    with run_stats.phase('get_server'):
+        server = get_server(dbs, options)
+
+    cert_index.refresh()
+    provisioner = Provisioner()
+    budget = WorkerBudget(server, options)
+    nginx_service, appservices, services = get_services(server, options,
+        budget, cert_index, cert_queue, provisioner)
+    bind_service = None
+    if options['output-bind']:
+        bind_service = BindService(options['output-bind'], server, options)
+        services += (bind_service,)
+
+    with run_stats.phase('vhost_query'):
+        listing = list_vhosts(dbs, [server])
+        file_state = cert_index.get_state(set(v.username for v in listing))
+        users, wildcards, certs = get_state_changes(
+            load_state(options['state-dir'], 'files.json'), file_state)
+        code = get_code_hash()
+        code_changed = load_state(options['state-dir'], 'code.json') != code
+        if code_changed:
+            logging.info('server: tfhnode or its templates changed')
+        if vhostids is not None and not code_changed:
+            vhostids = set(vhostids) | cert_queue.pending
+        elif options['gen-all'] or not server.lastupdate or code_changed:
+            logging.info('server: regenerating everything')
+            vhostids = set(v.id for v in listing)
+        else:
+            vhostids = get_changed_vhost_ids(dbs, [server], cert_queue.pending)
+        # Certificates and http directories are not in the database
+        if wildcards:
+            logging.info('server: wildcard certificates changed')
+            vhostids |= set(v.id for v in listing)
+        else:
+            vhostids |= set(v.id for v in listing if v.username in users)
+        # Forget vhosts that were deleted
+        vhostids &= set(v.id for v in listing)
+        budget.allocate(listing)
+        # Other vhosts sharing an output file with the changed ones, or
+        # whose pool changed
+        vhostids |= nginx_service.get_affected_vhosts(listing, vhostids) \
+            | budget.get_affected_vhosts(listing)
+    cert_queue.pending &= vhostids
+    with run_stats.phase('stale_removal'):
+        remove_stale_vhosts(listing, nginx_service, appservices)
+    logging.info('server: %d vhosts to generate'%(len(vhostids)))
+
+    with get_render_pool(options) as render_pool:
+        generate_batches(dbs, [server], vhostids, listing, nginx_service,
+            appservices, options, run_stats, render_pool)
+    with run_stats.phase('generate'):
+        nginx_service.generate_global(listing,
+            *get_server_names(dbs, [server]).get(server.id, (0, 0)))
+    # Parts of the generate phase
+    run_stats.add_phase('ssl_lookup', nginx_service.ssl_time)
+    run_stats.add_phase('file_writes', sum(s.write_time for s in services))
+
+    if bind_service:
+        with run_stats.phase('dns'):
+            generate_zones(dbs, bind_service,
+                None if options['gen-all'] else server.lastupdate)
+
+    if options['nss-cache-dir']:
+        # New users must resolve before their directories are chowned
+        with run_stats.phase('nss_cache'):
+            write_nss_cache(dbs, options['nss-cache-dir'])
+
+    # Directories used by the new configuration, before reloading
+    with run_stats.phase('provisioning'):
+        provisioner.run()
+
+    if certs:
+        # nginx only reads certificates when reloaded, one renewed in
+        # place does not change its config
+        logging.info('server: certificates changed')
+        nginx_service.changed = True
+
+    if options['reload-services']:
+        with run_stats.phase('reload_services'):
+            reload_services(services)
+
+    # Vhosts are served over HTTP only while their certificate is being
+    # generated, a later run adds their SSL server.
+    cert_queue.start()
+    cert_queue.save()
+    nginx_service.save_shards(listing)
+    nginx_service.save_microcache()
+    budget.save()
+
+    with run_stats.phase('commit'):
+        # Batches were expunged from the session, with the server
+        server = dbs.query(Server).get(server.id)
+        server.lastupdate = run_start
+        dbs.commit()
+    # Files changed while we ran will be picked up by the next run
+    save_state(options['state-dir'], 'files.json', file_state)
+    save_state(options['state-dir'], 'code.json', code)
+    fqdn = server.fqdn
+    dbs.close()
+
+    return finish_run(run_stats, options, fqdn, len(vhostids), services)
+
+def generate_servers(dbs, options, run_stats=None):
+    # Controller mode: generate the changed vhosts of many servers, each
+    # in its own output tree. Certificates and http directories are
+    # those the server exported (see get_node_cert_index).
+    if run_stats is None:
+        run_stats = RunStats(int(options['slow-vhosts']))
+
+    run_start = datetime.datetime.now()
+    with run_stats.phase('get_server'):
+        servers = get_servers(dbs, options)
+
+    nodes = {}
+    node_states = {}
+    for server in servers:
+        node_options = get_node_options(options, server)
+        cert_index = get_node_cert_index(options, server)
+        node_states[server.id] = (node_options['state-dir'], cert_index.state)
+        budget = WorkerBudget(server, node_options)
+        nodes[server.id] = (budget,) + get_services(server, node_options,
+            budget, cert_index)
+
+    with run_stats.phase('vhost_query'):
+        listings = {}
+        for v in list_vhosts(dbs, servers):
+            listings.setdefault(v.serverid, []).append(v)
+        if options['gen-all']:
+            changed = set(v.id for l in listings.values() for v in l)
+        else:
+            changed = get_changed_vhost_ids(dbs, servers)
+        code = get_code_hash()
+        server_vhostids = {}
+        for server in servers:
+            budget, nginx_service = nodes[server.id][:2]
+            listing = listings.get(server.id, [])
+            vhostids = changed & set(v.id for v in listing)
+            if load_state(node_states[server.id][0], 'code.json') != code:
+                logging.info('%s: tfhnode or its templates changed, '
+                    'regenerating everything'%(server.fqdn))
+                vhostids = set(v.id for v in listing)
+            users, wildcards, certs = get_state_changes(
+                load_state(node_states[server.id][0], 'files.json'),
+                node_states[server.id][1])
+            vhostids |= set(v.id for v in listing
+                if wildcards or v.username in users)
+            budget.allocate(listing)
+            server_vhostids[server.id] = vhostids \
+                | nginx_service.get_affected_vhosts(listing, vhostids) \
+                | budget.get_affected_vhosts(listing)
+        server_names = get_server_names(dbs, servers)
+
+    all_services = []
+    with get_render_pool(options) as render_pool:
+        for server in servers:
+            budget, nginx_service, appservices, services = nodes[server.id]
+            listing = listings.get(server.id, [])
+            vhostids = server_vhostids[server.id]
+            with run_stats.phase('stale_removal'):
+                remove_stale_vhosts(listing, nginx_service, appservices)
+            logging.info('%s: %d vhosts to generate'%(
+                server.fqdn, len(vhostids)))
+            generate_batches(dbs, servers, vhostids, listing, nginx_service,
+                appservices, options, run_stats, render_pool)
+            with run_stats.phase('generate'):
+                nginx_service.generate_global(listing,
+                    *server_names.get(server.id, (0, 0)))
+            nginx_service.save_shards(listing)
+            nginx_service.save_microcache()
+            budget.save()
+            run_stats.add_phase('ssl_lookup', nginx_service.ssl_time)
+            run_stats.add_phase('file_writes',
+                sum(s.write_time for s in services))
+            all_services += services
+
+    with run_stats.phase('commit'):
+        # Batches were expunged from the session, with the servers
+        for server in dbs.query(Server).filter(
+            Server.id.in_([s.id for s in servers])):
+            server.lastupdate = run_start
+        dbs.commit()
+    for state_dir, state in node_states.values():
+        save_state(state_dir, 'files.json', state)
+        save_state(state_dir, 'code.json', code)
+    dbs.close()
+
+    return finish_run(run_stats, options, socket.gethostname(),
+        sum(len(v) for v in server_vhostids.values()), all_services)
+
+def get_render_pool(options):
+    # Worker processes shared by all batches, started on first use
+    workers = get_workers(options['render-workers'])
+    if workers > 1:
+        return ProcessPoolExecutor(workers)
+    return nullcontext()
+
+def get_batches(vhostids, listing, nginx_service, batch_size):
+    # Lists of about batch_size vhost IDs. The vhosts of an output file
+    # (an nginx shard) are always in the same batch.
+    filenames = dict((v.id, nginx_service.get_filename(v.username, v.name))
+        for v in listing)
+    vhostids = sorted(vhostids, key=lambda i: (filenames[i], i))
+    batches = [[]]
+    for i, vhostid in enumerate(vhostids):
+        batches[-1].append(vhostid)
+        if len(batches[-1]) >= batch_size and i + 1 < len(vhostids) \
+            and filenames[vhostids[i + 1]] != filenames[vhostid]:
+            batches.append([])
+    return [b for b in batches if b]
+
+def generate_batches(dbs, servers, vhostids, listing, nginx_service,
+                     appservices, options, run_stats=None, render_pool=None):
+    # Load, render and write vhosts batch by batch, so that memory use
+    # does not depend on the number of vhosts.
+    if run_stats is None:
+        run_stats = RunStats(0)
+    for batch in get_batches(vhostids, listing, nginx_service,
+        int(options['batch-size'])):
+        with run_stats.phase('vhost_query'):
+            vhosts = [snapshot_vhost(v)
+                for v in query_vhosts_by_id(dbs, servers, batch)]
+            dbs.expunge_all()
+        with run_stats.phase('generate'):
+            generate_vhosts(vhosts, nginx_service, appservices,
+                get_workers(options['render-workers']),
+                get_workers(options['io-workers']), run_stats, render_pool)
+
+def get_node_options(options, server):
+    # Options of a server generated by the controller
+    root = os.path.join(options['output-root'], server.fqdn)
+    node_options = dict(options)
+    node_options.update({
+        'output-nginx' : os.path.join(root, 'nginx', ''),
+        'output-emperor' : os.path.join(root, 'emperor', ''),
+        'output-php' : os.path.join(root, 'phpfpm', ''),
+        'output-nginx-global' : os.path.join(root, 'nginx-global', ''),
+        'state-dir' : os.path.join(root, 'state', ''),
+        'make-http-dirs' : False,
+        'reload-services' : False,
+    })
+    for o in ('output-nginx', 'output-emperor', 'output-php',
+        'output-nginx-global', 'state-dir'):
+        if not os.path.exists(node_options[o]):
+            os.makedirs(node_options[o])
+    return node_options
+
+def get_node_cert_index(options, server):
+    # Certificates and http directories of a server generated by the
+    # controller, from the node-files.json copied from it
+    root = os.path.join(options['output-root'], server.fqdn)
+    state = load_state(root, 'node-files.json')
+    if state is None:
+        logging.warning('%s: no node-files.json, vhosts are generated '
+            'without SSL in ~/http_<vhost>'%(server.fqdn))
+    cert_index = NodeCertIndex(state)
+    cert_index.refresh()
+    return cert_index
+
+def get_services(server, options, budget, cert_index, cert_queue=None,
+                 provisioner=None):
+    nginx_service = NginxService(options['output-nginx'], '/run/nginx.pid',
+        server=server, options=options, cert_index=cert_index,
+        cert_queue=cert_queue, provisioner=provisioner)
+    uwsgi_service = UwsgiService(options['output-emperor'], budget)
+    phpfpm_service = PhpfpmService(options['output-php'], '/run/php5-fpm.pid',
+        budget)
+    services = (nginx_service, uwsgi_service, phpfpm_service)
+
+    appservices = {
+        0x10 : phpfpm_service,
+        0x20 : uwsgi_service,
+    }
+    return nginx_service, appservices, services
+
+def finish_run(run_stats, options, server_name, vhost_count, services):
+    run_stats.values['timestamp'] = time.time()
+    run_stats.values['server'] = server_name
+    run_stats.values['vhosts'] = vhost_count
+    if options['run-budget']:
+        run_stats.values['budget'] = float(options['run-budget'])
+    run_stats.add_services(services)
+    summary = run_stats.summary()
+    export_run_stats(summary, options)
+    return summary
+
+def export_run_stats(summary, options):
+    if summary.get('budget') and summary['duration'] > summary['budget']:
+        logging.warning('server: run took %.3fs, over its %.3fs budget'%(
+            summary['duration'], summary['budget']))
+    if options['metrics-textfile']:
+        write_file(options['metrics-textfile'],
+            prometheus_metrics(summary, {'server': summary['server']}))
+    if options['report-json']:
+        write_file(options['report-json'], json.dumps(summary, indent=2))
+
+def run_daemon(dbe, Session, options, cert_index, cert_queue, query_stats):
+    def new_run_stats():
+        return RunStats(int(options['slow-vhosts']), query_stats)
+
+    # Catch up with what changed while we were not running
+    generate(Session(), options, cert_index, cert_queue,
+        run_stats=new_run_stats())
+
+    if dbe.dialect.name == 'postgresql':
+        watcher = NotifyWatcher(dbe, float(options['daemon-debounce']))
+    else:
+        dbs = Session()
+        serverid = get_server(dbs, options).id
+        dbs.close()
+        watcher = PollWatcher(Session, serverid, float(options['daemon-poll']))
+    logging.info('daemon: waiting for changes (%s)'%(
+        watcher.__class__.__name__))
+
+    while True:
+        try:
+            # Certificates and http directories are checked when nothing
+            # changed for daemon-files seconds
+            vhostids = watcher.wait(float(options['daemon-files']))
+            if vhostids == set():
+                logging.debug('daemon: checking files and zones')
+            else:
+                logging.info('daemon: changes in %s'%(
+                    'vhosts '+', '.join(map(str, sorted(vhostids)))
+                    if vhostids is not None else 'unknown vhosts'))
+            generate(Session(), options, cert_index, cert_queue, vhostids,
+                new_run_stats())
+        except KeyboardInterrupt:
+            return
+        except Exception:
+            # Keep running, the next change or poll will retry.
+            logging.exception('daemon: generation failed')
+            time.sleep(float(options['daemon-poll']))
+
+def get_server(dbs, options):
+    hostname = options['hostname'] or socket.gethostname()
+    logging.info('server: hostname is %s'%(hostname))
+
+    server = dbs.query(Server).filter_by(fqdn=hostname).first()
+    if not server:
+        logging.critical('server: Cannot find server id in database.')
+        exit(1)
+
+    logging.info('server: #%d Last run: %s'%(server.id, server.lastupdate))
+    return server
+
+def get_servers(dbs, options):
+    query = dbs.query(Server).order_by(Server.fqdn)
+    if options['servers']:
+        fqdns = set(s.strip() for s in options['servers'].split(',') if s.strip())
+        query = query.filter(Server.fqdn.in_(fqdns))
+    servers = []
+    for server in query:
+        # Used as a directory name
+        if not server.fqdn or '/' in server.fqdn or server.fqdn.startswith('.'):
+            logging.error('server: #%d: invalid fqdn %r, skipped',
+                server.id, server.fqdn)
+            continue
+        servers.append(server)
+    if options['servers']:
+        for fqdn in fqdns - set(s.fqdn for s in servers):
+            logging.error('server: Cannot find server %s in database.', fqdn)
+    logging.info('server: generating %d servers'%(len(servers)))
+    return servers
+
+def query_vhosts(dbs, servers):
+    # Load everything the services need up front, in a fixed number of
+    # queries whatever the number of vhosts.
+    return dbs.query(VHost).filter(
+        VHost.serverid.in_([s.id for s in servers])).options(
+        joinedload(VHost.user).joinedload(User.group),
+        subqueryload(VHost.domains),
+        subqueryload(VHost.rewrites),
+        subqueryload(VHost.acls),
+        subqueryload(VHost.errorpages),
+    )
+
+def get_changed_vhost_ids(dbs, servers, pending_ssl=()):
+    # IDs of the vhosts changed since the last run of their server.
+    # VHost.update is also bumped when its domains, rewrites, ACLs
+    # or error pages change (see models.touch_vhosts). Vhosts without
+    # one were not changed since tfhsetup.py --make-dbcolumns.
+    changed = []
+    for server in servers:
+        if server.lastupdate:
+            changed.append(and_(VHost.serverid == server.id,
+                VHost.update > server.lastupdate))
+        else:
+            changed.append(VHost.serverid == server.id)
+    if pending_ssl:
+        changed.append(VHost.id.in_(pending_ssl))
+    return set(v.id for v in dbs.query(VHost.id).filter(
+        VHost.serverid.in_([s.id for s in servers]), or_(*changed)))
+
+def query_vhosts_by_id(dbs, servers, vhostids, chunk=500):
+    vhostids = sorted(vhostids)
+    vhosts = []
+    for i in range(0, len(vhostids), chunk):
+        vhosts += query_vhosts(dbs, servers) \
+            .filter(VHost.id.in_(vhostids[i:i+chunk])).all()
+    return vhosts
+
+def list_vhosts(dbs, servers):
+    # Every vhost of the servers, without loading them
+    return dbs.query(VHost.id, VHost.name, VHost.apptype, User.username,
+            VHost.serverid, VHost.traffic, VHost.microcache) \
+        .join(VHost.user) \
+        .filter(VHost.serverid.in_([s.id for s in servers])).all()
+
+def get_server_names(dbs, servers):
+    # serverid -> (number of domains, length of the longest one)
+    return dict((serverid, (count, length or 0)) for serverid, count, length
+        in dbs.query(VHost.serverid, func.count(Domain.id),
+            func.max(func.length(Domain.domain)))
+        .join(Domain, Domain.vhostid == VHost.id)
+        .filter(VHost.serverid.in_([s.id for s in servers]))
+        .group_by(VHost.serverid))
+
+def generate_zones(dbs, bind_service, since, chunk=500):
+    # Every hosted zone is generated, not only those of this server's
+    # vhosts: each node with --output-bind is one of the --dns-nameservers
+    # and serves all of them.
+    # Domains are loaded by chunks of changed zones and forgotten once
+    # written, whatever the number of zones.
+    domains = dbs.query(Domain.id, Domain.domain, Domain.update) \
+        .filter(Domain.hostedns == True).all()
+    domainids = sorted(bind_service.get_changed_zones(domains, since))
+    logging.info('dns: %d zones to generate'%(len(domainids)))
+    for i in range(0, len(domainids), chunk):
+        loaded = dbs.query(Domain).options(subqueryload(Domain.entries)) \
+            .filter(Domain.id.in_(domainids[i:i+chunk])).all()
+        for domain in loaded:
+            bind_service.generate_zone(domain)
+            for entry in domain.entries:
+                dbs.expunge(entry)
+            dbs.expunge(domain)
+    bind_service.remove_stale_zones(domains)
+    bind_service.write_include()
+    bind_service.save()
+
+def remove_stale_vhosts(vhosts, nginx_service, appservices):
+    nginx_service.remove_stale([nginx_service.get_filename(v.username, v.name)
+        for v in vhosts])
+    for apptype, service in appservices.items():
+        service.remove_stale([service.get_filename(v.username, v.name)
+            for v in vhosts if v.apptype & apptype])
+
+def reload_services(services):
+    # Files are only rewritten when their content changes, so a service
+    # without changes does not need to be reloaded (nginx is also
+    # reloaded when certificates change).
+    for service in services:
+        if service.changed:
+            service.reload()
+        else:
+            logging.info('%s: unchanged, not reloading'%(
+                service.__class__.__name__))
@@ -0,0 +1,148 @@
+from subprocess import Popen, PIPE, DEVNULL
+import os
+import pwd
+import stat
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+gpg_binary = 'gpg'
+# One GnuPG home per user and key, the cache_size most recently used
+# ones are kept. cache_dir must be private to the effective user, or a
+# temporary keyring is used (see set_cache_dir).
+cache_dir = os.path.join(pwd.getpwuid(os.geteuid()).pw_dir, '.cache',
+    'tfhnode-gpg')
+cache_size = 256
+
+def set_cache_dir(path):
+    global cache_dir
+    cache_dir = path
+
+def is_private(path):
+    # Whether path is a directory only the effective user can access
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() \
+        and not st.st_mode & 0o077
+
+def get_cache_dir():
+    # cache_dir, created if needed, or None if it cannot be used
+    try:
+        parent = os.path.dirname(cache_dir.rstrip('/'))
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent, mode=0o700)
+        os.mkdir(cache_dir, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        logging.error('gpg: cannot create %s: %s', cache_dir, e)
+        return None
+    if not is_private(cache_dir):
+        logging.error('gpg: %s is not a private directory, not used',
+            cache_dir)
+        return None
+    return cache_dir
+
+def run_gpg(home, args, data=b'', pass_fds=()):
+    # Returns the status lines. Importing and verifying public keys does
+    # not need a gpg-agent, none is left running per home.
+    proc = Popen([gpg_binary, '--homedir', home, '--batch', '--no-tty',
+        '--no-autostart', '--status-fd', '1'] + args, stdin=PIPE,
+        stdout=PIPE, stderr=DEVNULL, pass_fds=pass_fds)
+    out, err = proc.communicate(data)
+    return out.decode('utf-8', 'replace').splitlines()
+
+def import_key(home, key):
+    # Returns the fingerprints of the imported keys
+    fingerprints = [l.split()[3] for l in run_gpg(home, ['--import'], key)
+        if l.startswith('[GNUPG:] IMPORT_OK ')]
+    with open(os.path.join(home, 'fingerprints'), 'w') as fh:
+        fh.write('\n'.join(fingerprints))
+    return fingerprints
+
+def get_keyring(userid, key):
+    # Returns the GnuPG home containing key, the key fingerprints, and
+    # whether the home is temporary (to remove once used)
+    directory = get_cache_dir()
+    if directory is None:
+        home = tempfile.mkdtemp(prefix='tfhnode-gpg-')
+        return home, import_key(home, key), True
+
+    name = '%d-%s'%(userid, hashlib.sha1(key).hexdigest())
+    home = os.path.join(directory, name)
+    if is_private(home):
+        try:
+            with open(os.path.join(home, 'fingerprints')) as fh:
+                fingerprints = fh.read().split()
+            os.utime(home)
+            return home, fingerprints, False
+        except FileNotFoundError:
+            pass
+    elif os.path.lexists(home):
+        logging.error('gpg: %s is not a private directory, not used', home)
+
+    tmp = tempfile.mkdtemp(prefix='.import-', dir=directory)
+    fingerprints = import_key(tmp, key)
+    try:
+        os.rename(tmp, home)
+    except OSError:
+        # Imported at the same time by another process
+        return tmp, fingerprints, True
+
+    # Keyrings of the previous keys of this user
+    for f in os.listdir(directory):
+        if f.startswith('%d-'%(userid)) and f != name:
+            shutil.rmtree(os.path.join(directory, f), ignore_errors=True)
+    evict(directory)
+    return home, fingerprints, False
+
+def evict(directory):
+    homes = [os.path.join(directory, f) for f in os.listdir(directory)
+        if not f.startswith('.')]
+    if len(homes) <= cache_size:
+        return
+    homes.sort(key=lambda h: os.stat(h).st_mtime)
+    for home in homes[:len(homes) - cache_size]:
+        logging.debug('gpg: evicting %s'%(home))
+        shutil.rmtree(home, ignore_errors=True)
+
+def verify_signature(userid, key, cleartext, signature):
+    """ Check that signature is a valid signature of cleartext by key.
+
+    The data is sent on gpg's stdin and the signature through a pipe,
+    nothing is written to disk once the keyring is cached.
+    """
+    if not key:
+        return False
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    home, fingerprints, temporary = get_keyring(userid, key)
+
+    r, w = os.pipe()
+    def write_signature():
+        try:
+            with os.fdopen(w, 'wb') as fh:
+                fh.write(bytes(signature, 'utf-8'))
+        except BrokenPipeError:
+            pass
+    writer = threading.Thread(target=write_signature)
+    writer.start()
+    try:
+        status = run_gpg(home, ['--enable-special-filenames', '--verify',
+            '--', '-&%d'%(r), '-'], bytes(cleartext, 'utf-8'), pass_fds=(r,))
+    finally:
+        os.close(r)
+        writer.join()
+        if temporary:
+            shutil.rmtree(home, ignore_errors=True)
+
+    for line in status:
+        fields = line.split()
+        if fields[:2] == ['[GNUPG:]', 'VALIDSIG']:
+            # The last field is the fingerprint of the primary key
+            return fields[-1] in fingerprints
+    return False
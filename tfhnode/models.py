@@ -1,12 +1,9 @@
 from sqlalchemy import *
+from sqlalchemy import event
 from sqlalchemy.orm import *
+from sqlalchemy.orm.attributes import get_history
 import datetime
 from sqlalchemy.ext.declarative import declarative_base
-import inspect
-import re
-import crypt
-import tempfile
-import subprocess
 
 class MyBase(object):
     natural_key = None
@@ -32,7 +29,10 @@ class User(Base):
     pgppk    = deferred(Column(Binary()))
     email    = Column(String(512))
     signup_date = Column(DateTime, default=datetime.datetime.now, nullable=False)
+    groupid  = Column(ForeignKey('groups.id'), index=True)
+    shell    = Column(String(128))
     
+    group    = relationship('Group', foreign_keys=[groupid])
     vhosts   = relationship('VHost', backref='user')
     logins   = relationship('LoginHistory', backref='user')
     domains  = relationship('Domain', backref='user')
@@ -41,34 +41,16 @@ class User(Base):
     natural_key = 'username'
     
     def check_password(self, cleartext):
+        import crypt
         return self.password == crypt.crypt(cleartext, self.password)
 
     def set_password(self, cleartext):
+        import crypt
         self.password = crypt.crypt(cleartext)
 
     def verify_signature(self, cleartext, signature):
-        import gnupg
-        import shutil
-        import os
-
-        gpghome = tempfile.mkdtemp()
-        text_file = tempfile.mkstemp()[1]
-        sign_file = tempfile.mkstemp()[1]
-        
-        with open(text_file, 'wb') as f:
-            f.write(bytes(cleartext, 'utf-8'))
-        with open(sign_file, 'wb') as f:
-            f.write(bytes(signature, 'utf-8'))
-
-        gpg = gnupg.GPG(gnupghome=gpghome)
-        i = gpg.import_keys(self.pgppk)
-        v = gpg.verify_file(open(sign_file, 'rb'), text_file)
-        
-        os.remove(text_file)
-        os.remove(sign_file)
-        shutil.rmtree(gpghome)
-        
-        return i and v and v.pubkey_fingerprint in i.fingerprints
+        from .gpg import verify_signature
+        return verify_signature(self.id, self.pgppk, cleartext, signature)
 
 usergroup_association = Table('usergroups', Base.metadata,
     Column('userid', Integer, ForeignKey('users.id')),
@@ -99,12 +81,15 @@ class Domain(Base):
     display_name = 'Domains'
     id       = Column(Integer, primary_key=True)
     userid   = Column(ForeignKey('users.id'), nullable=False)
-    domain   = Column(String(256), nullable=False)
+    domain   = Column(String(256), nullable=False, index=True)
     hostedns = Column(Boolean, nullable=False)
-    vhostid  = Column(ForeignKey('vhosts.id'))
+    vhostid  = Column(ForeignKey('vhosts.id'), index=True)
     public   = Column(Boolean, default=False, nullable=False)
     verified = Column(Boolean, nullable=False, default=False)
     verif_token = Column(String(64))
+    # Last change of the domain or its entries, for zone generation
+    update   = Column(DateTime, default=datetime.datetime.now,
+                      onupdate=datetime.datetime.now)
     
     entries  = relationship('DomainEntry', backref='domain')
     mailboxes= relationship('Mailbox', backref='domain')
@@ -116,7 +101,7 @@ class DomainEntry(Base):
     short_name = 'domainentry'
     display_name = 'Domain Entries'
     id       = Column(Integer, primary_key=True)
-    domainid = Column(ForeignKey('domains.id'), nullable=False)
+    domainid = Column(ForeignKey('domains.id'), nullable=False, index=True)
     sub      = Column(String(256))
     rdatatype= Column(Integer, nullable=False)
     rdata    = Column(Text, nullable=False)
@@ -127,6 +112,14 @@ class Mailbox(Base):
     __tablename__ = 'mailboxes'
     short_name = 'mailbox'
     display_name = 'Mailboxes'
+    __table_args__ = (
+        # Postfix and Dovecot lookups, by domain then local part
+        Index('ix_mailboxes_domainid_local_part', 'domainid', 'local_part'),
+        # Catch-all addresses
+        Index('ix_mailboxes_catchall', 'domainid',
+            postgresql_where=text('local_part IS NULL'),
+            sqlite_where=text('local_part IS NULL')),
+    )
     id       = Column(Integer, primary_key=True)
     userid   = Column(ForeignKey('users.id'), nullable=False)
     domainid = Column(ForeignKey('domains.id'), nullable=False)
@@ -146,10 +139,32 @@ class Mailbox(Base):
     
     natural_key = 'address'
 
+class Server(Base):
+    __tablename__ = 'servers'
+    short_name = 'server'
+    display_name = 'Servers'
+    id       = Column(Integer, primary_key=True)
+    name     = Column(String(64))
+    fqdn     = Column(String(256), unique=True, nullable=False)
+    ipv4     = Column(String(15))
+    ipv6     = Column(String(39))
+    lastupdate = Column(DateTime)
+    # Budget of php-fpm and uWSGI workers (memory in MB)
+    cpus     = Column(Integer)
+    memory   = Column(Integer)
+
+    vhosts   = relationship('VHost', backref='server')
+
+    natural_key = 'fqdn'
+
 class VHost(Base):
     __tablename__ = 'vhosts'
     short_name = 'vhost'
     display_name = 'VHosts'
+    __table_args__ = (
+        # Changed vhosts of a server
+        Index('ix_vhosts_serverid_update', 'serverid', 'update'),
+    )
     
     appTypes = {
         0x00 : 'None',
@@ -161,15 +176,34 @@ class VHost(Base):
         0x40 : 'Node.js',
         0x80 : 'Perl',
     }
+
+    staticProfiles = {
+        0 : 'Off',
+        1 : 'Conservative',
+        2 : 'Aggressive',
+    }
     
     id       = Column(Integer, primary_key=True)
     name     = Column(String(32), nullable=False)
-    userid   = Column(ForeignKey('users.id'), nullable=False)
-    update   = Column(DateTime, onupdate=datetime.datetime.now)
+    userid   = Column(ForeignKey('users.id'), nullable=False, index=True)
+    serverid = Column(ForeignKey('servers.id'))
+    update   = Column(DateTime, default=datetime.datetime.now,
+                      onupdate=datetime.datetime.now)
     catchall = Column(String(256))
     autoindex= Column(Boolean, nullable=False, default=False)
     apptype  = Column(BigInteger, nullable=False, default=0)
     applocation = Column(String(512))
+    # Requests per second, from access logs statistics
+    traffic  = Column(Float, nullable=False, default=0, server_default='0')
+    # Client caching of static files (staticProfiles), for the space
+    # separated static_extensions or the default ones
+    static_profile = Column(Integer, nullable=False, default=0,
+                            server_default='0')
+    static_extensions = Column(String(256))
+    # Seconds anonymous responses of the PHP or uWSGI app are cached by
+    # nginx (0: off)
+    microcache = Column(Integer, nullable=False, default=0,
+                        server_default='0')
     
     natural_key = 'name'
     
@@ -183,7 +217,7 @@ class VHostRewrite(Base):
     short_name = 'rewrite'
     __tablename__ = 'vhostrewrites'
     id       = Column(Integer, primary_key=True)
-    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False)
+    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False, index=True)
     regexp   = Column(String(256), nullable=False)
     dest     = Column(String(256), nullable=False)
     redirect_temp = Column(Boolean, nullable=False, default=False)
@@ -197,7 +231,7 @@ class VHostACL(Base):
     __tablename__ = 'vhostacls'
     id       = Column(Integer, primary_key=True)
     title    = Column(String(256), nullable=False)
-    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False)
+    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False, index=True)
     regexp   = Column(String(256), nullable=False)
     passwd   = Column(String(256), nullable=False)
     
@@ -207,7 +241,53 @@ class VHostErrorPage(Base):
     short_name = 'ep'
     __tablename__ = 'vhosterrorpages'
     id       = Column(Integer, primary_key=True)
-    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False)
+    vhostid  = Column(ForeignKey('vhosts.id'), nullable=False, index=True)
     code     = Column(Integer, nullable=False)
     path     = Column(String(256), nullable=False)
 
+# Rows that end up in a vhost's generated config. Changing one of them
+# bumps VHost.update so tfhnode can regenerate only what changed.
+vhost_children = (Domain, VHostRewrite, VHostACL, VHostErrorPage)
+# Same for Domain.update and DNS zones
+domain_children = (DomainEntry,)
+
+@event.listens_for(Session, 'before_flush')
+def touch_vhosts(session, flush_context, instances):
+    now = datetime.datetime.now()
+    vhosts = set()
+    vhostids = set()
+    domains = set()
+    domainids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, domain_children):
+            domains.update(get_history(obj, 'domain').sum())
+            domainids.update(get_history(obj, 'domainid').sum())
+        if isinstance(obj, vhost_children):
+            # Both the old and the new vhost when it is moved.
+            h = get_history(obj, 'vhost')
+            vhosts.update(h.sum())
+            h = get_history(obj, 'vhostid')
+            vhostids.update(h.sum())
+        elif isinstance(obj, User) and get_history(obj, 'username').deleted:
+            # Output filenames contain the username.
+            vhosts.update(obj.vhosts)
+
+    with session.no_autoflush:
+        for vhostid in vhostids:
+            if vhostid is None:
+                continue
+            vhost = session.query(VHost).get(vhostid)
+            if vhost is not None:
+                vhosts.add(vhost)
+        for domainid in domainids:
+            if domainid is None:
+                continue
+            domain = session.query(Domain).get(domainid)
+            if domain is not None:
+                domains.add(domain)
+    for vhost in vhosts:
+        if vhost is not None and vhost not in session.deleted:
+            vhost.update = now
+    for domain in domains:
+        if domain is not None and domain not in session.deleted:
+            domain.update = now
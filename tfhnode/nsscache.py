@@ -0,0 +1,96 @@
+from .models import User, Group, usergroup_association
+from .services import file_hash
+import os
+import hashlib
+import logging
+
+# Same fields as templates/nss-pgsql.conf
+default_shell = '/bin/bash'
+shadow_fields = '15066:0:99999:7:7:99999:0'
+
+# map -> (index name, field) for libnss-cache .ix<name> files
+indexes = {
+    'passwd' : (('name', 0), ('uid', 2)),
+    'group' : (('name', 0), ('gid', 2)),
+    'shadow' : (('name', 0),),
+}
+
+def get_maps(dbs):
+    # map name -> lines
+    groups = dbs.query(Group.id, Group.name).order_by(Group.id).all()
+    users = dbs.query(User.id, User.username, User.groupid, User.shell,
+        User.password).order_by(User.id).all()
+    members = {}
+    for u in users:
+        if u.groupid is not None:
+            members.setdefault(u.groupid, []).append(u.username)
+    usernames = dict((u.id, u.username) for u in users)
+    for userid, groupid in dbs.query(usergroup_association.c.userid,
+            usergroup_association.c.groupid) \
+            .order_by(usergroup_association.c.userid):
+        if userid in usernames and usernames[userid] not in members.get(groupid, []):
+            members.setdefault(groupid, []).append(usernames[userid])
+
+    passwd, shadow = [], []
+    for u in users:
+        if u.groupid is None:
+            logging.debug('nss: user %s has no group, skipped'%(u.username))
+            continue
+        passwd.append('%s:x:%d:%d::/home/%s:%s'%(u.username, u.id, u.groupid,
+            u.username, u.shell or default_shell))
+        shadow.append('%s:%s:%s'%(u.username, u.password or '*',
+            shadow_fields))
+    group = ['%s:x:%d:%s'%(g.name, g.id, ','.join(members.get(g.id, [])))
+        for g in groups]
+    return {'passwd': passwd, 'group': group, 'shadow': shadow}
+
+def get_index(lines, field):
+    # One fixed-length line per key, sorted: "key\0offset\0<padding>\n".
+    # libnss-cache binary searches them.
+    positions = {}
+    offset = 0
+    for line in lines:
+        positions.setdefault(line.split(':')[field], offset)
+        offset += len(line.encode('utf-8')) + 1
+    if not positions:
+        return ''
+    length = max(len(k.encode('utf-8')) + len(str(p))
+        for k, p in positions.items())
+    out = ''
+    for key in sorted(positions, key=lambda k: k.encode('utf-8')):
+        pos = str(positions[key])
+        out += '%s\0%s\0%s\n'%(key, pos,
+            '\0' * (length - len(key.encode('utf-8')) - len(pos)))
+    return out
+
+def replace_file(filename, data, mode):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        os.fchmod(fh.fileno(), mode)
+        fh.write(data)
+    os.replace(tmp, filename)
+
+def write_nss_cache(dbs, output_dir):
+    """ Export users and groups to libnss-cache files in output_dir
+    (passwd.cache, group.cache, shadow.cache and their indexes).
+
+    Only maps whose content changed are replaced. Returns the names of
+    the replaced maps.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    changed = []
+    for name, lines in sorted(get_maps(dbs).items()):
+        filename = os.path.join(output_dir, name+'.cache')
+        data = ''.join(l+'\n' for l in lines).encode('utf-8')
+        if file_hash(filename) == hashlib.sha1(data).hexdigest():
+            continue
+        mode = 0o600 if name == 'shadow' else 0o644
+        # Indexes point into the new file, swap them right after it
+        replace_file(filename, data, mode)
+        for index, field in indexes[name]:
+            replace_file('%s.ix%s'%(filename, index),
+                get_index(lines, field).encode('utf-8'), mode)
+        logging.info('nss: updated %s'%(filename))
+        changed.append(name)
+    return changed
@@ -0,0 +1,81 @@
+from .services import render_job, write_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+import os
+import time
+import logging
+
+# Below that, starting worker processes costs more than it saves.
+parallel_min_jobs = 200
+
+def get_workers(value):
+    # 0 means one per CPU
+    workers = int(value)
+    return workers if workers > 0 else os.cpu_count() or 1
+
+def write_one(item):
+    filename, (service, content) = item
+    start = time.time()
+    written = write_file(filename, content)
+    return written, time.time() - start
+
+def generate_vhosts(vhosts, nginx_service, appservices, render_workers=1,
+                    io_workers=1, run_stats=None, render_pool=None):
+    """ Generate many vhosts (records, see records.snapshot_vhost).
+
+    Files are prepared here, rendered by render_workers processes (in
+    render_pool if given) and written by io_workers threads. The output
+    is the same as rendering them one by one.
+    """
+    jobs = []
+    durations = {}
+    seen = set()
+    for vhost in vhosts:
+        start = time.time()
+        services = [nginx_service] + [service for apptype, service
+            in appservices.items() if vhost.apptype & apptype]
+        for service in services:
+            for job in service.prepare_vhost(vhost):
+                if (job.filename, job.key) in seen:
+                    continue
+                seen.add((job.filename, job.key))
+                jobs.append(job)
+        durations[vhost.id] = time.time() - start
+
+    tasks = [(job.template, job.kwargs) for job in jobs]
+    if render_workers > 1 and len(jobs) >= parallel_min_jobs:
+        logging.debug('rendering %d files in %d processes'%(
+            len(jobs), render_workers))
+        chunksize = max(1, len(jobs) // (render_workers * 4))
+        if render_pool:
+            results = list(render_pool.map(render_job, tasks,
+                chunksize=chunksize))
+        else:
+            with ProcessPoolExecutor(render_workers) as pool:
+                results = list(pool.map(render_job, tasks, chunksize=chunksize))
+    else:
+        results = [render_job(task) for task in tasks]
+
+    # Assemble files from their parts, in a stable order
+    parts = OrderedDict()
+    for job, (output, duration) in zip(jobs, results):
+        job.service.render_time += duration
+        durations[job.vhostid] += duration
+        parts.setdefault(job.filename, (job.service, []))[1] \
+            .append((job.key or (), output))
+    files = OrderedDict()
+    for filename, (service, p) in parts.items():
+        files[filename] = (service, ''.join(o for k, o in
+            sorted(p, key=lambda part: part[0])))
+
+    if io_workers > 1 and len(files) > 1:
+        with ThreadPoolExecutor(io_workers) as pool:
+            written = list(pool.map(write_one, files.items()))
+    else:
+        written = [write_one(item) for item in files.items()]
+    for (filename, (service, content)), (w, duration) in zip(files.items(), written):
+        service.wrote(filename, w, duration)
+
+    if run_stats:
+        for vhost in vhosts:
+            run_stats.add_vhost(vhost, durations[vhost.id])
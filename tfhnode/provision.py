@@ -0,0 +1,75 @@
+import os
+import pwd
+import grp
+import signal
+import logging
+
+# (username, groupname) -> (uid, gid), for the current run. Unknown
+# users are not cached, they may exist by the next lookup.
+ids_cache = {}
+
+def get_ids(username, groupname=None):
+    # (uid, gid) of a user, gid of groupname if given and it exists
+    ids = ids_cache.get((username, groupname))
+    if ids is not None:
+        return ids
+    try:
+        pw = pwd.getpwnam(username)
+    except KeyError:
+        return None
+    gid = pw.pw_gid
+    if groupname:
+        try:
+            gid = grp.getgrnam(groupname).gr_gid
+        except KeyError:
+            pass
+    ids = ids_cache[(username, groupname)] = (pw.pw_uid, gid)
+    return ids
+
+def chown(path, username, groupname=None, recursive=False):
+    ids = get_ids(username, groupname)
+    if ids is None:
+        logging.error('Cannot chown %s: unknown user %s', path, username)
+        return False
+    os.chown(path, *ids)
+    if recursive:
+        for root, dirs, files in os.walk(path):
+            for f in dirs + files:
+                os.chown(os.path.join(root, f), *ids, follow_symlinks=False)
+    return True
+
+def signal_pidfile(pidfile, signame):
+    # Returns False if the process could not be signaled
+    try:
+        with open(pidfile) as fh:
+            pid = int(fh.read())
+        os.kill(pid, getattr(signal, signame))
+    except FileNotFoundError:
+        logging.warning('Pidfile %s not found', pidfile)
+        return False
+    except (ValueError, ProcessLookupError, PermissionError) as e:
+        logging.error('Failed to send %s to %s: %s', signame, pidfile, e)
+        return False
+    return True
+
+class Provisioner(object):
+    """ Filesystem changes for a run, made in one pass after rendering. """
+    def __init__(self):
+        self.dirs = []
+
+    def add_dir(self, path, username, groupname=None):
+        # Create path (if it does not exist) owned by username
+        self.dirs.append((path, username, groupname))
+
+    def run(self):
+        # Users may have been added or renumbered since the last run
+        ids_cache.clear()
+        for path, username, groupname in self.dirs:
+            if os.path.isdir(path):
+                continue
+            logging.info('-> creating %s'%(path))
+            os.makedirs(path)
+            if not chown(path, username, groupname, recursive=True):
+                # Not left owned by root, a later run will retry
+                os.rmdir(path)
+        self.dirs = []
@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+# Immutable copies of the ORM objects used to generate a vhost. They can
+# be sent to worker processes and do not keep the session busy.
+GroupRecord = namedtuple('GroupRecord', 'id name')
+UserRecord = namedtuple('UserRecord', 'id username group')
+DomainRecord = namedtuple('DomainRecord', 'id domain verified')
+RewriteRecord = namedtuple('RewriteRecord',
+    'id regexp dest redirect_temp redirect_perm last')
+ACLRecord = namedtuple('ACLRecord', 'id title regexp passwd')
+ErrorPageRecord = namedtuple('ErrorPageRecord', 'id code path')
+VHostRecord = namedtuple('VHostRecord', 'id name update catchall autoindex '
+    'apptype applocation static_profile static_extensions microcache user '
+    'domains rewrites acls errorpages')
+
+def snapshot_user(user):
+    group = None
+    if user.group:
+        group = GroupRecord(user.group.id, user.group.name)
+    return UserRecord(user.id, user.username, group)
+
+def snapshot_vhost(vhost):
+    return VHostRecord(
+        id = vhost.id,
+        name = vhost.name,
+        update = vhost.update,
+        catchall = vhost.catchall,
+        autoindex = vhost.autoindex,
+        apptype = vhost.apptype,
+        applocation = vhost.applocation,
+        static_profile = vhost.static_profile,
+        static_extensions = vhost.static_extensions,
+        microcache = vhost.microcache,
+        user = snapshot_user(vhost.user),
+        domains = tuple(DomainRecord(d.id, d.domain, d.verified)
+            for d in vhost.domains),
+        rewrites = tuple(RewriteRecord(r.id, r.regexp, r.dest,
+            r.redirect_temp, r.redirect_perm, r.last) for r in vhost.rewrites),
+        acls = tuple(ACLRecord(a.id, a.title, a.regexp, a.passwd)
+            for a in vhost.acls),
+        errorpages = tuple(ErrorPageRecord(e.id, e.code, e.path)
+            for e in vhost.errorpages),
+    )
@@ -0,0 +1,28 @@
+from mako.lookup import TemplateLookup
+import os
+import hashlib
+
+template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+template_lookup = TemplateLookup(directories=[template_dir])
+
+def set_cache_dir(cache_dir):
+    """ Keep compiled templates in cache_dir between runs.
+
+    Mako recompiles a module when the template is newer than it; the
+    module name also contains a hash of the template source, so a
+    template replaced by an older file is not served from the cache.
+    """
+    global template_lookup
+
+    def module_name(filename, uri):
+        with open(filename, 'rb') as fh:
+            h = hashlib.sha1(fh.read()).hexdigest()[:16]
+        return os.path.join(cache_dir, '%s.%s.py'%(uri.strip('/'), h))
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    template_lookup = TemplateLookup(directories=[template_dir],
+        module_directory=cache_dir, modulename_callable=module_name)
+
+def get_template(name):
+    return template_lookup.get_template(name)
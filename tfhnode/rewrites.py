@@ -0,0 +1,138 @@
+from collections import namedtuple
+import re
+import logging
+
+# nginx evaluates rewrite rules one by one, each with a regex. A run of
+# redirects from literal paths (^/path$) or literal prefixes (^/path)
+# is compiled to a map instead: one hash lookup (prefixes are regexes
+# in the map, tried after the exact paths). Maps are case-insensitive,
+# so the matched path is checked again by a second map.
+
+# A step of the rewrite phase of a vhost: a rule (VHostRewrite or its
+# record) rendered as is, or a RewriteMap.
+RewriteStep = namedtuple('RewriteStep', 'rule map')
+# entries: (map key, matched $uri, dest)
+RewriteMap = namedtuple('RewriteMap', 'name code entries')
+
+# Runs of fewer rules are not worth a map
+map_threshold = 2
+# Longer paths, or more rules, would not fit nginx's default
+# map_hash_bucket_size (64) and map_hash_max_size (2048)
+max_key_length = 40
+max_map_entries = 1000
+
+literal_chars = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    '0123456789/_-~%!,:@=&')
+# nginx config syntax
+invalid_regexp_re = re.compile(r'[\s;{}\'"]')
+invalid_dest_re = re.compile(r'[\x00-\x1f\'\\]')
+absolute_dest_re = re.compile(r'^(/|https?://|\$scheme)')
+
+def check_rule(rule):
+    # Returns an error message, or None if the rule is valid
+    if invalid_regexp_re.search(rule.regexp):
+        return 'invalid character in regexp %r'%(rule.regexp)
+    if invalid_dest_re.search(rule.dest):
+        return 'invalid character in destination %r'%(rule.dest)
+    try:
+        # PCRE named groups
+        re.compile(rule.regexp.replace('(?<', '(?P<')
+            .replace('(?P<=', '(?<=').replace('(?P<!', '(?<!'))
+    except re.error as e:
+        return 'invalid regexp %r: %s'%(rule.regexp, e)
+    return None
+
+def parse_literal(regexp):
+    # (path, exact) if regexp only matches a literal path or prefix
+    if not regexp.startswith('^/'):
+        return None
+    body, exact = regexp[1:], False
+    if body.endswith('$') and not body.endswith('\\$'):
+        body, exact = body[:-1], True
+    path = ''
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if c == '\\' and i + 1 < len(body) and body[i+1] in '.+/-':
+            c = body[i+1]
+            i += 1
+        elif c not in literal_chars:
+            return None
+        path += c
+        i += 1
+    return path, exact
+
+def get_code(rule):
+    # HTTP status of a redirect to an absolute URL (relative ones get
+    # the scheme and $server_name in the template), None otherwise
+    if not absolute_dest_re.match(rule.dest):
+        return None
+    if rule.redirect_perm and not rule.redirect_temp:
+        return 301
+    return 302
+
+def get_target(dest, ssl_enable):
+    # Same URL as the rewrite directive in templates/nginx.conf
+    if dest.startswith('/'):
+        return 'http%s://$server_name%s'%('s' if ssl_enable else '', dest)
+    return dest
+
+def conflicts(entries, path, exact):
+    # Whether path would not be looked up in the same order as rules
+    for other_path, other_exact in entries:
+        if exact and other_exact and other_path.lower() == path.lower():
+            return True
+        if exact != other_exact:
+            prefix, full = (other_path, path) if exact else (path, other_path)
+            if full.lower().startswith(prefix.lower()):
+                return True
+    return False
+
+def compile_rewrites(vhostid, rewrites):
+    """ Returns the steps of the rewrite phase of a vhost (a list of
+    RewriteStep), in the order of the rules. Invalid rules are skipped.
+    """
+    # Rules, and runs of rules that can go in a map: [code, literals, rules]
+    steps = []
+    for rule in sorted(rewrites, key=lambda r: r.id):
+        error = check_rule(rule)
+        if error:
+            logging.warning('vhost#%d/nginx: rewrite #%d: %s, skipped',
+                vhostid, rule.id, error)
+            continue
+        literal = parse_literal(rule.regexp)
+        code = get_code(rule)
+        # Without a '?' nginx appends the query string, the map adds it
+        if literal is None or code is None or '?' in rule.dest \
+            or re.search(r'\$\d', rule.dest) \
+            or len(literal[0]) > max_key_length:
+            steps.append(rule)
+            continue
+        run = steps[-1] if steps else None
+        if not isinstance(run, list) or run[0] != code \
+            or len(run[2]) >= max_map_entries or conflicts(run[1], *literal):
+            run = [code, [], []]
+            steps.append(run)
+        run[1].append(literal)
+        run[2].append(rule)
+
+    compiled = []
+    for step in steps:
+        if not isinstance(step, list):
+            compiled.append(RewriteStep(step, None))
+            continue
+        code, literals, rules = step
+        if len(rules) < map_threshold:
+            compiled += [RewriteStep(rule, None) for rule in rules]
+            continue
+        entries = []
+        for (path, exact), rule in zip(literals, rules):
+            if exact:
+                entries.append((path, path, rule.dest))
+            else:
+                entries.append(('~^' + re.sub(r'([.+])', r'\\\1', path),
+                    '$uri', rule.dest))
+        name = 'tfh_rewrite_%d_%d'%(vhostid,
+            sum(1 for s in compiled if s.map))
+        compiled.append(RewriteStep(None, RewriteMap(name, code, entries)))
+    return compiled
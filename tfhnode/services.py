@@ -1,18 +1,161 @@
 from .models import VHost, User
-from mako.template import Template
+from .render import get_template
+from .provision import signal_pidfile
+from .budget import get_pool_keys
+from .rewrites import compile_rewrites
+from collections import namedtuple
 import os
+import re
+import json
+import zlib
 import logging
+import hashlib
+import time
 import subprocess
 
+def file_hash(filename):
+    try:
+        with open(filename, 'rb') as fh:
+            return hashlib.sha1(fh.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def write_file(filename, content):
+    # Only write when the content differs from what is on disk, through a
+    # temporary file so readers never see a partial file.
+    # Returns True if the file was written.
+    data = content.encode('utf-8')
+    if hashlib.sha1(data).hexdigest() == file_hash(filename):
+        return False
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmp, filename)
+    return True
+
+def next_power_of_two(n):
+    return 1 << max(0, n - 1).bit_length()
+
+def get_cache_zone(vhosts):
+    # (keys zone, max size) in MB of a microcache shared by vhosts,
+    # None if it is unused. 1 MB of keys zone holds about 8000 keys.
+    if not vhosts:
+        return None
+    return (min(256, max(8, vhosts * 1000 // 8000)),
+        min(8192, max(256, vhosts * 16)))
+
+def get_nginx_tuning(vhosts, names, name_length, fastcgi_cached=0,
+                     uwsgi_cached=0):
+    # Parameters of templates/nginx-global.conf for a server with vhosts
+    # vhosts, names server names and name_length the longest one, and
+    # *_cached vhosts with a microcache.
+    # A bucket of the server_names hash must hold the longest name
+    # (NGX_HASH_ELT_SIZE) and an end pointer; with twice as many slots
+    # as names nginx finds a size where buckets stay short.
+    elt = 8 + (name_length + 2 + 7) // 8 * 8
+    worker_connections = min(65536, max(1024, next_power_of_two(vhosts * 4)))
+    open_files = min(100000, max(1000, vhosts * 10))
+    return dict(
+        names_max_size = max(512, next_power_of_two(names * 2)),
+        names_bucket_size = max(64, next_power_of_two(elt + 8)),
+        worker_connections = worker_connections,
+        open_files = open_files,
+        # Every worker keeps the two logs of each vhost open, and up to
+        # two descriptors per connection
+        nofile = vhosts * 2 + worker_connections * 2 + open_files,
+        keepalive_timeout = 65 if vhosts < 1000 else 30 if vhosts < 10000
+            else 15,
+        fastcgi_cache = get_cache_zone(fastcgi_cached),
+        uwsgi_cache = get_cache_zone(uwsgi_cached),
+    )
+
+# VHost.static_profile -> nginx settings of the static files location
+StaticProfile = namedtuple('StaticProfile',
+    'expires cache_control access_log gzip_static')
+static_profiles = {
+    1 : StaticProfile('1h', 'public', True, False),
+    2 : StaticProfile('30d', 'public, immutable', False, True),
+}
+default_static_extensions = ('css', 'js', 'gif', 'jpg', 'jpeg', 'png', 'webp',
+    'svg', 'ico', 'woff', 'woff2', 'ttf', 'eot', 'otf', 'mp4', 'webm', 'pdf')
+static_extension_re = re.compile(r'^[a-z0-9]{1,16}$')
+# Served by the application, never as a static file
+app_extension_re = re.compile(r'^(php\d*|phtml|phar)$')
+
+def get_static_location(vhost):
+    # (StaticProfile, extensions) of a vhost, None without profile
+    profile = static_profiles.get(vhost.static_profile)
+    if not profile:
+        return None
+    if vhost.acls:
+        # A regex location would bypass their authentication
+        logging.warning('vhost#%d/nginx: static profile ignored, the vhost '
+            'has ACLs'%(vhost.id))
+        return None
+    extensions = default_static_extensions
+    if vhost.static_extensions:
+        extensions = []
+        for e in vhost.static_extensions.lower().replace(',', ' ').split():
+            e = e.lstrip('.')
+            if not static_extension_re.match(e) or app_extension_re.match(e):
+                logging.warning('vhost#%d/nginx: invalid static extension '
+                    '%r, skipped'%(vhost.id, e))
+            elif e not in extensions:
+                extensions.append(e)
+    if not extensions:
+        return None
+    return profile, extensions
+
+# A part of an output file, produced by Service.prepare_vhost().
+# Parts of a file are sorted by key and concatenated; parts with the same
+# filename and key are only rendered once.
+# template is None for an empty part.
+Job = namedtuple('Job', 'service vhostid filename key template kwargs')
+
+def render_job(job):
+    # Only needs the template name and arguments, so that it can run in
+    # a worker process. Returns the output and the time it took.
+    template, kwargs = job
+    start = time.time()
+    if template is None:
+        return '', 0.0
+    output = get_template(template).render(**kwargs)
+    return output, time.time() - start
+
 class Service(object):
-    def clear(self):
-        if hasattr(self, 'output_dir'):
-            for f in os.listdir(self.output_dir):
-                if f.endswith(self.output_ext):
-                    os.remove(self.output_dir+'/'+f)
-        elif hasattr(self, 'output_file'):
-            if os.path.isfile(self.output_file):
-                os.remove(self.output_file)
+    changed = False
+    written = 0
+    render_time = 0.0
+    write_time = 0.0
+
+    def wrote(self, filename, written, duration):
+        self.write_time += duration
+        if written:
+            logging.debug('-> wrote %s'%(filename))
+            self.changed = True
+            self.written += 1
+
+    def write_file(self, filename, content):
+        start = time.time()
+        written = write_file(filename, content)
+        self.wrote(filename, written, time.time() - start)
+
+    def generate_vhost(self, vhost):
+        # Render and write right away, see pipeline.generate_vhosts()
+        # for many vhosts.
+        for job in self.prepare_vhost(vhost):
+            output, duration = render_job((job.template, job.kwargs))
+            self.render_time += duration
+            self.write_file(job.filename, output)
+
+    def remove_stale(self, keep):
+        # Remove every output file not in keep (a set of filenames)
+        keep = set(os.path.basename(f) for f in keep)
+        for f in os.listdir(self.output_dir):
+            if f.endswith(self.output_ext) and f not in keep:
+                logging.info('-> removing stale %s'%(f))
+                os.remove(os.path.join(self.output_dir, f))
+                self.changed = True
             
     def reload(self):
         if hasattr(self, 'pidfile'):
@@ -20,94 +163,138 @@ class Service(object):
                 signal = self.reload_signal
             else:
                 signal = 'SIGHUP'
-            process = self.__class__.__name__
-            try:
-                pid = int(open(self.pidfile).read())
-                r = subprocess.call(['kill', '-'+signal, str(pid)])
-                if r != 0:
-                    logging.error('Failed to sent %s to %s!', signal, process)
-            except FileNotFoundError:
-                logging.warning('Pidfile not found for '+process)
+            if not signal_pidfile(self.pidfile, signal):
+                logging.error('Failed to reload %s!', self.__class__.__name__)
     
-    def generate_vhost(self, vhost):
+    def get_filename(self, username, name):
         raise NotImplementedError()
-        
-def get_ssl_certs(vhost):
-    # User-provided SSL cert
-    base = '/home/%s/ssl/%s' % (vhost.user.username, vhost.name)
-    user_cert, user_csr, user_key = base+'.crt', base+'.csr', base+'.key'
-    if os.path.isfile(user_cert) and os.path.isfile(user_key):
-        logging.debug('-> found user SSL cert.')
-        return (user_cert, user_key)
-    
-    # System-wide wildcard
-    for domain in vhost.domains:
-        parts = domain.domain.split('.')
-        for i in range(1, len(parts)-1):
-            hmm = '.'.join(parts[i:])
-            cert = '/etc/ssl/tfhcerts/wildcard.%s.crt' % (hmm)
-            key  = '/etc/ssl/tfhkeys/wildcard.%s.key' % (hmm)
-            if os.path.isfile(cert) and os.path.isfile(key):
-                logging.debug('-> found wildcard SSL cert.')
-                return (cert, key)
-
-    # None found, generate a self-signed cert
-    # TODO: CACert ?
-    
-    bits = 4096
-    days = 3650
-    cert_org = 'Tux-FreeHost'
-    
-    ssl_dir = '/home/%s/ssl/'%(vhost.user.username)
-    if not os.path.isdir(ssl_dir):
-        os.makedirs(ssl_dir)
-
-    logging.debug('-> generating RSA key...')
-    subprocess.call(['openssl', 'genrsa', '-out', user_key, str(bits)])
-    os.chmod(user_key, 0o400)
-
-    logging.debug('-> generating CSR...')
-    subprocess.call(['openssl', 'req', '-new', '-days', str(days),
-        '-key', user_key, '-out', user_csr, '-batch',
-        '-subj', '/C=FR/O=%s/CN=%s'%(cert_org, vhost.domains[0].domain)])
-    
-    logging.debug('-> generating certificate...')
-    subprocess.call(['openssl', 'x509', '-req', '-days', str(days),
-        '-in', user_csr, '-signkey', user_key, '-out', user_cert])
-    
-    for f in (user_cert, user_csr, user_key):
-        subprocess.call(['chown', vhost.user.username, f])
-    
-    return (user_cert, user_key)
 
+    def prepare_vhost(self, vhost):
+        # Returns a list of Job
+        raise NotImplementedError()
+        
 class NginxService(Service):
-    def __init__(self, output, pidfile, server, options):
+    def __init__(self, output, pidfile, server, options, cert_index,
+                 cert_queue=None, provisioner=None):
         self.output_dir = output
         self.output_ext = '.conf'
         self.pidfile = pidfile
         self.reload_signal = 'SIGHUP'
         self.options = options
-        self.template = Template(filename=os.path.join(os.path.dirname(__file__), 'templates/nginx.conf'))
+        self.template = 'nginx.conf'
         self.server = server
+        self.cert_index = cert_index
+        self.cert_queue = cert_queue
+        self.provisioner = provisioner
+        self.ssl_time = 0.0
+        self.shards = int(options.get('nginx-shards') or 0)
+        self.shards_file = os.path.join(options['state-dir'], 'nginx-shards.json')
+        self.global_dir = options.get('output-nginx-global')
+        self.microcache_dir = options.get('microcache-dir')
+        self.microcache_file = os.path.join(options['state-dir'],
+            'nginx-microcache.json')
+        # The cache zones are in the global include, and nginx refuses a
+        # config whose cache path does not exist
+        self.microcache = False
+        if options.get('microcache'):
+            if not self.global_dir:
+                logging.warning('nginx: microcache needs '
+                    'output-nginx-global, disabled')
+            elif not self.microcache_dir \
+                or not cert_index.is_dir(self.microcache_dir):
+                logging.warning('nginx: microcache-dir %s does not exist, '
+                    'microcache disabled', self.microcache_dir)
+            else:
+                self.microcache = True
 
-    def generate_vhost(self, vhost):
-        filename = self.output_dir + '%s_%s.conf'%(
-            vhost.user.username, vhost.name)
-        fh = open(filename, 'w')
+    def get_filename(self, username, name):
+        if self.shards:
+            # crc32 is stable between runs, unlike hash()
+            shard = zlib.crc32(username.encode('utf-8')) % self.shards
+            return self.output_dir + 'shard_%04d.conf'%(shard)
+        return self.output_dir + '%s_%s.conf'%(username, name)
+
+    def get_shards(self, vhosts):
+        # filename -> sorted vhost IDs
+        shards = {}
+        for v in vhosts:
+            shards.setdefault(self.get_filename(v.username, v.name), []) \
+                .append(v.id)
+        return dict((f, sorted(ids)) for f, ids in shards.items())
+
+    def get_affected_vhosts(self, vhosts, changed):
+        # A shard is rendered from all its vhosts: returns the IDs of the
+        # vhosts that share a shard with a changed vhost, or with a vhost
+        # that left since the last run. Vhosts with a microcache are
+        # affected when it was enabled or disabled since the last run.
+        changed = set(changed) | self.get_microcache_vhosts(vhosts)
+        if not self.shards:
+            return changed
+        try:
+            with open(self.shards_file) as fh:
+                old = json.load(fh)
+        except FileNotFoundError:
+            old = {}
+        shards = self.get_shards(vhosts)
+        affected = set()
+        for filename, ids in shards.items():
+            if old.get(filename) != ids or set(ids) & changed:
+                affected.update(ids)
+        return affected
+
+    def get_microcache_vhosts(self, vhosts):
+        try:
+            with open(self.microcache_file) as fh:
+                old = json.load(fh)
+        except FileNotFoundError:
+            old = None
+        if old == self.microcache:
+            return set()
+        return set(v.id for v in vhosts if v.microcache)
+
+    def save_microcache(self):
+        tmp = self.microcache_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.microcache, fh)
+        os.replace(tmp, self.microcache_file)
+
+    def save_shards(self, vhosts):
+        if not self.shards:
+            return
+        tmp = self.shards_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.get_shards(vhosts), fh)
+        os.replace(tmp, self.shards_file)
+
+    def generate_global(self, vhosts, names, name_length):
+        # main.conf, events.conf and http.conf in output-nginx-global.
+        # vhosts: every vhost of the server (see list_vhosts)
+        if not self.global_dir:
+            return
+        cached = [v for v in vhosts if v.microcache and self.microcache]
+        tuning = get_nginx_tuning(len(vhosts), names, name_length,
+            sum(1 for v in cached if v.apptype & 0x10),
+            sum(1 for v in cached if v.apptype & 0x20))
+        template = get_template('nginx-global.conf')
+        for part in ('main', 'events', 'http'):
+            self.write_file(os.path.join(self.global_dir, part+'.conf'),
+                template.render(part=part, microcache_dir=self.microcache_dir,
+                    server_addresses=[a for a in (self.server.ipv4,
+                        self.server.ipv6) if a], **tuning))
+
+    def prepare_vhost(self, vhost):
+        filename = self.get_filename(vhost.user.username, vhost.name)
+        key = (vhost.user.username, vhost.name)
         if len(vhost.domains) < 1:
             logging.warning('vhost#%d/nginx: no domain associated.'%(vhost.id))
-            return
+            return [Job(self, vhost.id, filename, key, None, None)]
         
-        pubdir = '/home/%s/http_%s/' % (vhost.user.username, vhost.name)
-        oldpubdir = '/home/%s/public_http/' % (vhost.user.username)
-        if not os.path.isdir(pubdir):
-            if os.path.isdir(oldpubdir):
-                # Use ~/public_http
-                pubdir = oldpubdir
-            elif self.options['make-http-dirs']:
-                os.makedirs(pubdir)
-                os.system('chown %s:%s -R %s'%(
-                    vhost.user.username, vhost.user.username, pubdir))
+        # ~/http_<vhost>, or ~/public_http
+        pubdir, exists = self.cert_index.get_pubdir(vhost.user.username,
+            vhost.name)
+        if not exists and self.options['make-http-dirs'] and self.provisioner:
+            self.provisioner.add_dir(pubdir, vhost.user.username,
+                vhost.user.username)
         
         appsocket = None
         if vhost.apptype & 0x20: # uwsgi apps
@@ -128,12 +315,23 @@ class NginxService(Service):
         ssl_enable = False
         ssl_cert = None
         ssl_key = None
-        r = get_ssl_certs(vhost)
+        start = time.time()
+        r = self.cert_index.lookup(vhost)
+        self.ssl_time += time.time() - start
         if r:
             ssl_cert, ssl_key = r
             ssl_enable = True
+            if self.cert_queue:
+                self.cert_queue.pending.discard(vhost.id)
+        elif self.cert_queue:
+            # HTTP only until the certificate is ready
+            self.cert_queue.submit(vhost)
 
-        fh.write(self.template.render(
+        # Only when the server's cache zones are generated
+        microcache = vhost.microcache if self.microcache else 0
+
+        return [Job(self, vhost.id, filename, key, self.template, dict(
+            vhostid = vhost.id,
             listen_addr = addresses,
             user = vhost.user.username,
             name = vhost.name,
@@ -143,92 +341,232 @@ class NginxService(Service):
             ssl_key = ssl_key,
             pubdir = pubdir,
             hostnames = ' '.join([d.domain for d in domains]),
+            # The plain HTTP server of an SSL vhost has every domain
+            plain_hostnames = ' '.join([d.domain for d in vhost.domains]),
             autoindex = vhost.autoindex,
             catchall = vhost.catchall,
-            rewrites = vhost.rewrites,
+            rewrites = compile_rewrites(vhost.id, vhost.rewrites),
+            static = get_static_location(vhost),
+            microcache = microcache,
             error_pages = vhost.errorpages,
             acl = vhost.acls,
             apptype = vhost.apptype,
             appsocket = appsocket,
             applocation = vhost.applocation,
-        ))
-        
-        if ssl_enable:
-            # Add the same vhost without SSL
-            fh.write(self.template.render(
-                listen_addr = addresses,
-                user = vhost.user.username,
-                name = vhost.name,
-                ssl_enable = False,
-                ssl_port = self.options['ssl-port'],
-                ssl_cert = None,
-                ssl_key = None,
-                pubdir = pubdir,
-                hostnames = ' '.join([d.domain for d in vhost.domains]),
-                autoindex = vhost.autoindex,
-                catchall = vhost.catchall,
-                rewrites = vhost.rewrites,
-                error_pages = vhost.errorpages,
-                acl = vhost.acls,
-                apptype = vhost.apptype,
-                appsocket = appsocket,
-                applocation = vhost.applocation,
-            ))
-        fh.close()
+        ))]
     
 class UwsgiService(Service):
-    def __init__(self, output):
+    def __init__(self, output, budget):
         self.output_dir = output
         self.output_ext = '.ini'
-        self.template = Template(filename=os.path.join(os.path.dirname(__file__), './templates/uwsgi.ini'))
+        self.template = 'uwsgi.ini'
+        self.budget = budget
 
-    def generate_vhost(self, vhost):
-        filename = self.output_dir + '/%s_%s.ini'%(
-            vhost.user.username, vhost.name)
+    def get_filename(self, username, name):
+        return self.output_dir + '/%s_%s.ini'%(username, name)
+
+    def prepare_vhost(self, vhost):
+        filename = self.get_filename(vhost.user.username, vhost.name)
 
         real_location = '/home/'+vhost.user.username+'/'+vhost.applocation
         real_location = os.path.realpath(real_location)
         if not real_location.startswith('/home/'+vhost.user.username+'/'):
             logging.warning('vhost#%d/nginx: uwsgi app trying to get out its of /home')
-            return
+            return []
 
         logging.info('-> uwsgi app')
-        fh = open(filename, 'w')
-        fh.write(self.template.render(
+        key, = get_pool_keys(vhost.user.username, vhost.name, 0x20)
+        return [Job(self, vhost.id, filename, None, self.template, dict(
             vhost=vhost,
             user=vhost.user,
-            real_location=real_location
-        ))
-        fh.close()
+            real_location=real_location,
+            pool=self.budget.get(key),
+        ))]
         
     def remove_vhost(self, vhost):
-        filename = self.output_dir + '/%s_%s.ini'%(
-            vhost.user.username, vhost.name)
+        filename = self.get_filename(vhost.user.username, vhost.name)
         if os.path.isfile(filename):
             os.remove(filename)
         
 class PhpfpmService(Service):
-    def __init__(self, output, pidfile):
+    def __init__(self, output, pidfile, budget):
         self.output_dir = output
         self.output_ext = '.conf'
         self.pidfile = pidfile
         self.reload_signal = 'SIGUSR2'
-        self.template = Template(filename=os.path.join(os.path.dirname(__file__), './templates/phpfpm.conf'))
+        self.template = 'phpfpm.conf'
+        self.budget = budget
 
-    def generate_vhost(self, vhost):
-        filename = self.output_dir + '%s.conf'%(vhost.user.username)
-        # Never need to be changed, only created/deleted
-        if os.path.isfile(filename):
-            return
+    def get_filename(self, username, name):
+        # One pool per user
+        return self.output_dir + '%s.conf'%(username)
+
+    def prepare_vhost(self, vhost):
+        filename = self.get_filename(vhost.user.username, vhost.name)
         logging.info('-> php for '+vhost.user.username)
-        fh = open(filename, 'w')
-        fh.write(self.template.render(user=vhost.user.username))
-        fh.close()
+        key, = get_pool_keys(vhost.user.username, vhost.name, 0x10)
+        return [Job(self, vhost.id, filename, None, self.template,
+            dict(user=vhost.user.username, pool=self.budget.get(key)))]
 
     def remove_vhost(self, vhost):
-        filename = self.output_dir + '%s.conf'%(vhost.user.username)
+        filename = self.get_filename(vhost.user.username, vhost.name)
         if os.path.isfile(filename):
             os.remove(filename)
 
+# DomainEntry.rdatatype values
+rdatatypes = {
+    1 : 'A',
+    2 : 'NS',
+    5 : 'CNAME',
+    6 : 'SOA',
+    12 : 'PTR',
+    15 : 'MX',
+    16 : 'TXT',
+    28 : 'AAAA',
+    33 : 'SRV',
+    44 : 'SSHFP',
+    52 : 'TLSA',
+    257 : 'CAA',
+}
+zone_re = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)+$')
+record_name_re = re.compile(r'^(@|[A-Za-z0-9_*-]+(\.[A-Za-z0-9_-]+)*\.?)$')
 
+class BindService(Service):
+    """ Zone files of hosted domains (Domain.hostedns) and a named.conf
+    include listing them.
 
+    The serial and a hash of each zone are kept in the state directory:
+    a zone is only rewritten, and its serial bumped, when its records
+    changed. Changed zones are reloaded one by one, BIND is only
+    reconfigured when zones are added or removed.
+    """
+    def __init__(self, output, server, options):
+        self.output_dir = output
+        self.output_ext = '.zone'
+        self.template = 'zone.db'
+        self.include_file = os.path.join(output, 'named.conf')
+        self.state_file = os.path.join(options['state-dir'], 'bind-zones.json')
+        self.ttl = int(options['dns-ttl'])
+        if options['dns-nameservers']:
+            self.nameservers = [n.strip().rstrip('.') for n
+                in options['dns-nameservers'].split(',') if n.strip()]
+        else:
+            self.nameservers = [server.fqdn]
+        self.hostmaster = options['dns-hostmaster']
+        self.reloaded = []
+        self.reconfig = False
+        try:
+            with open(self.state_file) as fh:
+                # zone -> [serial, hash]
+                self.zones = json.load(fh)
+        except FileNotFoundError:
+            self.zones = {}
+
+    def get_filename(self, zone):
+        return os.path.join(self.output_dir, zone + self.output_ext)
+
+    def get_zones(self, domains):
+        # zone -> domain ID, of the valid hosted domains
+        zones = {}
+        for d in sorted(domains, key=lambda d: d.id):
+            zone = d.domain.lower().rstrip('.')
+            if not zone_re.match(zone):
+                logging.warning('dns: invalid zone name %r, skipped', d.domain)
+            elif zone in zones:
+                logging.warning('dns: %s is hosted twice, skipped', zone)
+            else:
+                zones[zone] = d.id
+        return zones
+
+    def get_changed_zones(self, domains, since):
+        # IDs of the domains to generate: changed since the last run,
+        # or without a zone yet
+        zones = self.get_zones(domains)
+        changed = set()
+        for d in domains:
+            zone = d.domain.lower().rstrip('.')
+            if zones.get(zone) != d.id:
+                continue
+            if since is None or zone not in self.zones \
+                or (d.update is not None and d.update > since):
+                changed.add(d.id)
+        return changed
+
+    def generate_zone(self, domain):
+        zone = domain.domain.lower().rstrip('.')
+        filename = self.get_filename(zone)
+        records = []
+        for e in sorted(domain.entries, key=lambda e: e.id):
+            rdtype = rdatatypes.get(e.rdatatype, 'TYPE%d'%(e.rdatatype))
+            name = e.sub or '@'
+            if rdtype == 'SOA':
+                continue
+            # Anything else could add directives to the zone file
+            if not record_name_re.match(name) or '\n' in e.rdata \
+                or '\r' in e.rdata:
+                logging.warning('dns: %s: invalid entry #%d, skipped',
+                    zone, e.id)
+                continue
+            records.append((name, rdtype, e.rdata))
+
+        kwargs = dict(
+            zone = zone,
+            ttl = self.ttl,
+            primary = self.nameservers[0],
+            hostmaster = self.hostmaster or 'hostmaster.'+zone,
+            nameservers = self.nameservers,
+            records = records,
+        )
+        h = hashlib.sha1(json.dumps(kwargs, sort_keys=True)
+            .encode('utf-8')).hexdigest()
+        serial, old_hash = self.zones.get(zone, (0, None))
+        if h == old_hash and os.path.isfile(filename):
+            return
+        # YYYYMMDDnn, always increasing
+        serial = max(serial + 1, int(time.strftime('%Y%m%d')) * 100)
+        output, duration = render_job((self.template,
+            dict(kwargs, serial=serial)))
+        self.render_time += duration
+        self.write_file(filename, output)
+        if zone in self.zones:
+            self.reloaded.append(zone)
+        else:
+            self.reconfig = True
+        self.zones[zone] = [serial, h]
+
+    def remove_stale_zones(self, domains):
+        keep = self.get_zones(domains)
+        for zone in list(self.zones):
+            if zone not in keep:
+                logging.info('dns: removing zone %s'%(zone))
+                del self.zones[zone]
+                self.reconfig = True
+        self.remove_stale([self.get_filename(z) for z in keep])
+
+    def write_include(self):
+        # Only changes when zones are added or removed
+        if not self.reconfig and os.path.isfile(self.include_file):
+            return
+        template = get_template('bind.conf')
+        self.write_file(self.include_file, ''.join(template.render(
+            zone=zone, file=os.path.abspath(self.get_filename(zone)))
+            for zone in sorted(self.zones)))
+
+    def save(self):
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.zones, fh, sort_keys=True)
+        os.replace(tmp, self.state_file)
+
+    def rndc(self, *args):
+        try:
+            if subprocess.call(['rndc'] + list(args)) != 0:
+                logging.error('rndc %s failed!', ' '.join(args))
+        except FileNotFoundError:
+            logging.error('rndc not found!')
+
+    def reload(self):
+        if self.reconfig:
+            self.rndc('reconfig')
+        for zone in self.reloaded:
+            self.rndc('reload', zone)
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import heapq
+import time
+
+class QueryStats(object):
+    """ Count queries sent to the database and the time spent in them. """
+    def __init__(self, engine):
+        # Not at the top: runs with nothing to do export their metrics
+        # without loading SQLAlchemy
+        from sqlalchemy import event
+        self.count = 0
+        self.time = 0.0
+        self.start = time.time()
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        self._query_start = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        self.count += 1
+        self.time += time.time() - self._query_start
+
+    def report(self):
+        return 'queries: %d in %.3fs, total run time: %.3fs'%(
+            self.count, self.time, time.time() - self.start)
+
+class RunStats(object):
+    """ Timings of one generation run.
+
+    Phases are timed with `with run_stats.phase(name):`, the slowest
+    vhosts are kept with add_vhost().
+    """
+    def __init__(self, slow_vhosts=10, query_stats=None):
+        self.start = time.time()
+        self.phases = OrderedDict()
+        self.slow_vhosts = slow_vhosts
+        self.vhosts = []
+        self.query_stats = query_stats
+        self.query_start = query_stats.count if query_stats else 0
+        self.services = {}
+        self.values = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def add_phase(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def add_vhost(self, vhost, duration):
+        item = (duration, vhost.id, vhost.name)
+        if len(self.vhosts) < self.slow_vhosts:
+            heapq.heappush(self.vhosts, item)
+        elif self.slow_vhosts:
+            heapq.heappushpop(self.vhosts, item)
+
+    def add_services(self, services):
+        # Services of the same class (one per server in controller
+        # mode) are added up
+        for service in services:
+            s = self.services.setdefault(service.__class__.__name__, {
+                'written' : 0,
+                'render_time' : 0.0,
+                'write_time' : 0.0,
+            })
+            s['written'] += service.written
+            s['render_time'] += service.render_time
+            s['write_time'] += service.write_time
+
+    def summary(self):
+        summary = OrderedDict(self.values)
+        summary['duration'] = time.time() - self.start
+        summary['phases'] = self.phases
+        summary['services'] = self.services
+        summary['slow_vhosts'] = [{'id': i, 'name': n, 'duration': d}
+            for d, i, n in sorted(self.vhosts, reverse=True)]
+        if self.query_stats:
+            summary['queries'] = self.query_stats.count - self.query_start
+        return summary
+
+def get_skipped_summary(server, duration):
+    # RunStats.summary() of a run that found nothing to do
+    return OrderedDict([
+        ('timestamp', time.time()),
+        ('server', server),
+        ('vhosts', 0),
+        ('duration', duration),
+        ('phases', OrderedDict()),
+        ('services', {}),
+        ('slow_vhosts', []),
+    ])
+
+def prometheus_metrics(summary, labels):
+    # Prometheus text exposition format, for node-exporter's textfile
+    # collector.
+    def line(metric, value, **extra):
+        l = dict(labels, **extra)
+        l = ','.join('%s="%s"'%(k, str(v).replace('\\', '\\\\')
+            .replace('"', '\\"')) for k, v in sorted(l.items()))
+        return 'tfhnode_%s{%s} %s\n'%(metric, l, repr(float(value)))
+
+    out = ''
+    out += line('run_timestamp_seconds', summary['timestamp'])
+    out += line('run_duration_seconds', summary['duration'])
+    out += line('vhosts_generated', summary['vhosts'])
+    if 'queries' in summary:
+        out += line('db_queries', summary['queries'])
+    if summary.get('budget'):
+        out += line('run_budget_seconds', summary['budget'])
+        out += line('run_over_budget', summary['duration'] > summary['budget'])
+    for phase, duration in summary['phases'].items():
+        out += line('phase_duration_seconds', duration, phase=phase)
+    for service, s in sorted(summary['services'].items()):
+        out += line('service_render_seconds', s['render_time'], service=service)
+        out += line('service_write_seconds', s['write_time'], service=service)
+        out += line('service_files_written', s['written'], service=service)
+    for v in summary['slow_vhosts']:
+        out += line('slow_vhost_seconds', v['duration'],
+            vhost=v['id'], name=v['name'])
+    return out
@@ -0,0 +1,155 @@
+from .models import VHost, Server, Domain
+from sqlalchemy import func
+import select
+import time
+import logging
+
+notify_channel = 'tfhnode'
+
+# Installed by tfhsetup.py --make-dbtriggers.
+# Every change sends the ID of the affected vhost(s) on notify_channel,
+# or 'dns' for domains and their entries (zones are found by Domain.update).
+notify_tables = ('vhosts', 'domains', 'domainentries', 'vhostrewrites',
+    'vhostacls', 'vhosterrorpages', 'users')
+notify_function = """
+CREATE OR REPLACE FUNCTION tfhnode_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'vhosts' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('%(channel)s', OLD.id::text);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('%(channel)s', NEW.id::text);
+        END IF;
+    ELSIF TG_TABLE_NAME = 'users' THEN
+        IF TG_OP = 'UPDATE' AND OLD.username <> NEW.username THEN
+            PERFORM pg_notify('%(channel)s', id::text) FROM vhosts
+                WHERE userid = NEW.id;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'domainentries' THEN
+        PERFORM pg_notify('%(channel)s', 'dns');
+    ELSE
+        IF TG_TABLE_NAME = 'domains' THEN
+            PERFORM pg_notify('%(channel)s', 'dns');
+        END IF;
+        IF TG_OP <> 'INSERT' AND OLD.vhostid IS NOT NULL THEN
+            PERFORM pg_notify('%(channel)s', OLD.vhostid::text);
+        END IF;
+        IF TG_OP <> 'DELETE' AND NEW.vhostid IS NOT NULL THEN
+            PERFORM pg_notify('%(channel)s', NEW.vhostid::text);
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+""" % {'channel': notify_channel}
+notify_trigger = """
+DROP TRIGGER IF EXISTS tfhnode_notify ON %(table)s;
+CREATE TRIGGER tfhnode_notify AFTER INSERT OR UPDATE OR DELETE ON %(table)s
+    FOR EACH ROW EXECUTE PROCEDURE tfhnode_notify();
+"""
+
+class NotifyWatcher(object):
+    """ Wait for PostgreSQL notifications on notify_channel. """
+    def __init__(self, dbe, debounce, max_delay=2.0):
+        self.dbe = dbe
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.conn = None
+
+    def connect(self):
+        raw = self.dbe.raw_connection()
+        raw.detach()
+        self.conn = raw.connection
+        self.conn.autocommit = True
+        self.conn.cursor().execute('LISTEN %s'%(notify_channel))
+
+    def read(self, vhostids, timeout=None):
+        # Returns the number of notifications, False after timeout
+        if select.select([self.conn], [], [], timeout) == ([], [], []):
+            return False
+        self.conn.poll()
+        count = len(self.conn.notifies)
+        while self.conn.notifies:
+            n = self.conn.notifies.pop(0)
+            if n.payload == 'dns':
+                continue
+            try:
+                vhostids.add(int(n.payload))
+            except ValueError:
+                logging.warning('daemon: invalid notification %r', n.payload)
+        return count
+
+    def wait(self, timeout=None):
+        # Returns the IDs of changed vhosts (empty if only zones changed),
+        # None if unknown, or an empty set after timeout seconds without
+        # changes.
+        if self.conn is None:
+            self.connect()
+            # We may have missed changes while not listening
+            return None
+
+        vhostids = set()
+        try:
+            end = time.time() + timeout if timeout else None
+            while True:
+                count = self.read(vhostids,
+                    None if end is None else max(end - time.time(), 0))
+                if count is False:
+                    return vhostids
+                if count:
+                    break
+            # Wait for the end of a burst of changes, up to max_delay.
+            deadline = time.time() + self.max_delay
+            while time.time() < deadline:
+                timeout = min(self.debounce, deadline - time.time())
+                if not self.read(vhostids, max(timeout, 0)):
+                    break
+        except Exception:
+            logging.exception('daemon: lost database connection')
+            self.conn = None
+            time.sleep(1)
+            return None
+        return vhostids
+
+class PollWatcher(object):
+    """ Poll VHost.update and Domain.update for databases without
+    notifications. """
+    def __init__(self, Session, serverid, interval):
+        self.Session = Session
+        self.serverid = serverid
+        self.interval = interval
+        self.count = None
+
+    def wait(self, timeout=None):
+        end = time.time() + timeout if timeout else None
+        while True:
+            time.sleep(self.interval)
+            dbs = self.Session()
+            try:
+                changed = self.poll(dbs)
+            finally:
+                dbs.close()
+            if changed is not None:
+                return changed
+            if end is not None and time.time() >= end:
+                return set()
+
+    def poll(self, dbs):
+        server = dbs.query(Server).get(self.serverid)
+        vhostids = set(v.id for v in dbs.query(VHost.id).filter(
+            VHost.serverid == self.serverid,
+            VHost.update > server.lastupdate))
+        zones = dbs.query(func.count(Domain.id)).filter(
+            Domain.hostedns == True, Domain.update > server.lastupdate) \
+            .scalar()
+        # A deleted vhost or domain leaves no timestamp behind
+        count = (dbs.query(func.count(VHost.id))
+                .filter(VHost.serverid == self.serverid).scalar(),
+            dbs.query(func.count(Domain.id))
+                .filter(Domain.hostedns == True).scalar())
+        deleted = self.count is not None and count != self.count
+        self.count = count
+        if vhostids or zones or deleted:
+            return vhostids
+        return None
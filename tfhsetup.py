@@ -7,21 +7,34 @@ from argparse import ArgumentParser
 from configparser import ConfigParser
 import logging
 import os
+import datetime
+import hashlib
+import subprocess
+import json
+import re
 from tfhnode.models import *
 from sqlalchemy import *
-from mako.template import Template
+from sqlalchemy.engine.reflection import Inspector
+from tfhnode.render import get_template
+from tfhnode.services import file_hash
 
 options = {
     'db' : 'postgresql+psycopg2://tfhdev@localhost/tfhdev',
     'password-scheme' : 'SHA512-CRYPT',
+    'postfix-map-type' : 'lmdb',
 }
 
 generators = (
     # name              output path             generator
     ('dbtables',        None,                   'gen_tables'),
+    ('dbcolumns',       None,                   'gen_columns'),
     ('dbdata',          None,                   'gen_data'),
+    ('dbtriggers',      None,                   'gen_triggers'),
+    ('dbindexes',       None,                   'gen_indexes'),
+    ('dbexplain',       None,                   'gen_explain'),
     ('dovecot',         'dovecot-sql.conf',     'gen_dovecot'),
     ('postfix',         'postfix/',             'gen_postfix'),
+    ('postfix-maps',    'postfix-maps/',        'gen_postfix_maps'),
     ('pam-pgsql',       'pam_pgsql.conf',       'gen_pam_pgsql'),
     ('nss-pgsql',       'nss-pgsql.conf',       'gen_nss_pgsql'),
     ('nss-pgsql-root',  'nss-pgsql-root.conf',  'gen_nss_pgsql_root'),
@@ -74,6 +87,135 @@ dbe = create_engine(options['db'])
 def gen_tables():
     Base.metadata.create_all(dbe)
 
+def gen_triggers():
+    # Notifications for tfhnode.py --daemon (PostgreSQL only)
+    if dbe.dialect.name != 'postgresql':
+        logging.warning('dbtriggers: only supported on PostgreSQL')
+        return
+    from tfhnode.watch import notify_function, notify_trigger, notify_tables
+    with dbe.begin() as conn:
+        conn.execute(text(notify_function))
+        for table in notify_tables:
+            conn.execute(text(notify_trigger%{'table': table}))
+
+def gen_columns():
+    # Columns declared in the models, for tables created before them
+    from sqlalchemy.schema import CreateColumn
+    inspector = Inspector.from_engine(dbe)
+    tables = inspector.get_table_names()
+    preparer = dbe.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                logging.error('dbcolumns: cannot add %s.%s, NOT NULL without '
+                    'a server default', table.name, column.name)
+                continue
+            logging.info('dbcolumns: adding %s.%s'%(table.name, column.name))
+            with dbe.begin() as conn:
+                conn.execute(text('ALTER TABLE %s ADD COLUMN %s'%(
+                    preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=dbe.dialect))))
+
+    # Rows older than their update timestamp, or from before it had a
+    # default, would otherwise look changed to every tfhnode run
+    now = datetime.datetime.now()
+    for table in (VHost.__table__, Domain.__table__):
+        with dbe.begin() as conn:
+            r = conn.execute(table.update()
+                .where(table.c['update'] == None).values(update=now))
+        if r.rowcount:
+            logging.info('dbcolumns: set %s.update of %d rows',
+                table.name, r.rowcount)
+
+def gen_indexes():
+    # Indexes declared in the models, for tables created before them
+    inspector = Inspector.from_engine(dbe)
+    tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                logging.info('dbindexes: creating %s'%(index.name))
+                index.create(dbe)
+
+# Placeholders of the queries in generated configurations
+explain_values = {
+    'postfix' : {'%s': 'user@example.com', '%u': 'user', '%d': 'example.com'},
+    'dovecot' : {'%u': 'user@example.com', '%n': 'user', '%d': 'example.com'},
+    'pam' : {'%u': "'user'", '%p': "'password'"},
+    'nss' : {'$1': "'1'", '$2': "'1'"},
+}
+# Queries listing a whole table
+explain_full_scans = {
+    'nss' : {'allusers': {'users'}, 'allgroups': {'groups'},
+             'shadow': {'users'}},
+}
+
+def get_template_queries(name):
+    tpl = get_template(name)
+    queries = {}
+    for line in tpl.render(host='', db='', user='', password='',
+        passwdscheme='').splitlines():
+        key, sep, value = line.partition('=')
+        if sep and re.match(r'\s*(select|update)\s', value, re.I):
+            queries[key.strip()] = value.strip()
+    return queries
+
+def get_seq_scans(plan):
+    tables = set()
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        tables |= get_seq_scans(child)
+    return tables
+
+def gen_explain():
+    # Sequential scans in the queries run by Postfix, Dovecot, PAM and
+    # NSS. Seq scans are disabled, so the planner only uses one when no
+    # index can be used.
+    if dbe.dialect.name != 'postgresql':
+        logging.warning('dbexplain: only supported on PostgreSQL')
+        return
+    queries = [('postfix', k, v) for k, v in sorted(postfix_queries.items())]
+    for kind, template in (('dovecot', 'dovecot-sql.conf'),
+        ('pam', 'pam_pgsql.conf'), ('nss', 'nss-pgsql.conf'),
+        ('nss', 'nss-pgsql-root.conf')):
+        queries += [(kind, k, v) for k, v in
+            sorted(get_template_queries(template).items())]
+
+    problems = 0
+    conn = dbe.connect()
+    for kind, name, query in queries:
+        values = explain_values[kind]
+        query = re.sub(r'%[a-z]|\$[0-9]', lambda m: values.get(m.group(0),
+            m.group(0)), query).rstrip(';')
+        trans = conn.begin()
+        try:
+            conn.execute(text('SET LOCAL enable_seqscan = off'))
+            plan = conn.execute(text('EXPLAIN (FORMAT JSON) ' + query)
+                .execution_options(no_parameters=True)).scalar()
+        finally:
+            trans.rollback()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans = get_seq_scans(plan[0]['Plan']) \
+            - explain_full_scans.get(kind, {}).get(name, set())
+        if scans:
+            problems += 1
+            logging.error('dbexplain: %s %s: sequential scan on %s',
+                kind, name, ', '.join(sorted(scans)))
+        else:
+            logging.info('dbexplain: %s %s: ok'%(kind, name))
+    conn.close()
+    print('%d queries, %d with sequential scans'%(len(queries), problems))
+
 def gen_data():
     dbs = sessionmaker(bind=dbe)()
 
@@ -89,7 +231,7 @@ def gen_data():
     dbs.commit()
 
 def gen_dovecot(output):
-    tpl = Template(filename='./tfhnode/templates/dovecot-sql.conf')
+    tpl = get_template('dovecot-sql.conf')
     fh = open(output, 'w')
     fh.write(tpl.render(
         host=dbe.url.host, db=dbe.url.database,
@@ -99,27 +241,101 @@ def gen_dovecot(output):
     fh.close()
     os.chmod(output, 0o600)
 
+postfix_queries = {
+    'domains' : "SELECT '%s' AS output FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE domain='%s' LIMIT 1;",
+    'boxes' : "SELECT '%d/%u' FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE local_part='%u' AND domain='%d' AND redirect IS NULL",
+    'aliases' : "SELECT redirect FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE (local_part='%u' AND domain='%d' AND redirect IS NOT NULL) OR (local_part IS NULL AND domain='%d' AND redirect IS NOT NULL AND (SELECT COUNT(*) FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE local_part='%u' AND domain='%d') = 0)",
+}
+
 def gen_postfix(output):
     header = 'hosts = %s\nuser = %s\npassword = %s\ndbname = %s\n'%(
         dbe.url.host, dbe.url.username, dbe.url.password or '', dbe.url.database)
-    files = {
-        'domains' : "SELECT '%s' AS output FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE domain='%s' LIMIT 1;",
-        'boxes' : "SELECT '%d/%u' FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE local_part='%u' AND domain='%d' AND redirect IS NULL",
-        'aliases' : "SELECT redirect FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE (local_part='%u' AND domain='%d' AND redirect IS NOT NULL) OR (local_part IS NULL AND domain='%d' AND redirect IS NOT NULL AND (SELECT COUNT(*) FROM mailboxes LEFT JOIN domains ON domains.id = mailboxes.domainid WHERE local_part='%u' AND domain='%d') = 0)",
-    }
     if not os.path.isdir(output):
         os.makedirs(output)
-    for f in files.keys():
+    for f in postfix_queries.keys():
         filename = '%s/%s.cf' % (output, f)
         fh=open(filename, 'w')
         fh.write(header)
-        fh.write('query = '+files[f]+'\n')
+        fh.write('query = '+postfix_queries[f]+'\n')
         fh.close()
         os.chmod(filename, 0o600)
 
+def postmap(map_type, filename, content):
+    # Rebuild filename.<map_type> from content, only if it changed.
+    # Both are built aside and renamed, Postfix never sees a partial map.
+    data = content.encode('utf-8')
+    db = '%s.%s'%(filename, map_type)
+    if os.path.isfile(db) and \
+        file_hash(filename) == hashlib.sha1(data).hexdigest():
+        return False
+    tmp = filename + '.new'
+    with open(tmp, 'wb') as fh:
+        fh.write(data)
+    try:
+        subprocess.check_call(['postmap', '%s:%s'%(map_type, tmp)])
+    except FileNotFoundError:
+        os.remove(tmp)
+        raise
+    os.replace('%s.%s'%(tmp, map_type), db)
+    os.replace(tmp, filename)
+    return True
+
+def gen_postfix_maps(output):
+    # Static copies of the gen_postfix() queries, for
+    # <postfix-map-type>:<output>/{domains,boxes,aliases}
+    dbs = sessionmaker(bind=dbe)()
+    rows = dbs.query(Mailbox.local_part, Mailbox.redirect, Domain.domain) \
+        .join(Domain, Domain.id == Mailbox.domainid).all()
+    dbs.close()
+
+    domains = set()
+    boxes = {}
+    aliases = {}
+    catchalls = {}
+    addresses = set()
+    for local_part, redirect, domain in rows:
+        domains.add(domain)
+        if local_part is None:
+            if redirect is not None:
+                catchalls.setdefault(domain, []).append(redirect)
+            continue
+        address = local_part+'@'+domain
+        addresses.add((address, domain))
+        if redirect is None:
+            boxes.setdefault(address, []).append(domain+'/'+local_part)
+        else:
+            aliases.setdefault(address, []).append(redirect)
+
+    # The catch-all only applies to addresses without any row: the
+    # others are mapped to themselves, or the @domain entry would
+    # match them too.
+    for domain, redirects in catchalls.items():
+        aliases['@'+domain] = redirects
+    for address, domain in addresses:
+        if domain in catchalls and address not in aliases:
+            aliases[address] = [address]
+
+    maps = {
+        'domains' : dict((d, [d]) for d in domains),
+        'boxes' : boxes,
+        'aliases' : aliases,
+    }
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    for name, entries in sorted(maps.items()):
+        content = ''.join('%s\t%s\n'%(k, ', '.join(v))
+            for k, v in sorted(entries.items()))
+        try:
+            rebuilt = postmap(options['postfix-map-type'],
+                os.path.join(output, name), content)
+        except FileNotFoundError:
+            logging.error('postfix-maps: postmap not found!')
+            return
+        if rebuilt:
+            logging.info('postfix-maps: rebuilt %s'%(name))
 
 def gen_pam_pgsql(output):
-    tpl = Template(filename='./tfhnode/templates/pam_pgsql.conf')
+    tpl = get_template('pam_pgsql.conf')
     fh = open(output, 'w')
     fh.write(tpl.render(
         host=dbe.url.host, db=dbe.url.database,
@@ -129,7 +345,7 @@ def gen_pam_pgsql(output):
     os.chmod(output, 0o600)
     
 def gen_nss_pgsql(output):
-    tpl = Template(filename='./tfhnode/templates/nss-pgsql.conf')
+    tpl = get_template('nss-pgsql.conf')
     fh = open(output, 'w')
     fh.write(tpl.render(
         host=dbe.url.host, db=dbe.url.database,
@@ -141,7 +357,7 @@ def gen_nss_pgsql(output):
     os.chmod(output, 0o644)
 
 def gen_nss_pgsql_root(output):
-    tpl = Template(filename='./tfhnode/templates/nss-pgsql-root.conf')
+    tpl = get_template('nss-pgsql-root.conf')
     fh = open(output, 'w')
     fh.write(tpl.render(
         host=dbe.url.host, db=dbe.url.database,